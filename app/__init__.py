@@ -1,11 +1,12 @@
+from app.database import configure, RoutingSQLAlchemy
 from config import Config
 from flask import Flask
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+configure(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 
-from app import routes, models
\ No newline at end of file
+from app import routes, api, models, changes, changelog, experience, cli, instrumentation, versions, fragments, owners
\ No newline at end of file
@@ -0,0 +1,334 @@
+import base64
+import json
+import time
+
+from app import app
+from app.batch import run_batch
+from app.changelog import ChangesTrimmed, latest_seq, read_changes
+from app.database import read_only
+from app.exporter import encode, FORMATS, gzipped, search_headers, search_rows, table_rows, TARGETS
+from app.matrix import match_index, use_match_index
+from app.multisearch import run_searches, Search
+from app.owners import MATCH_MODES, rank_owners
+from app.ranking import iter_rankings, normalize_devices
+from app.viewmodels import result_rows
+from flask import jsonify, request, Response, stream_with_context
+
+class ApiError(Exception):
+    """
+    A bad API request, answered with a JSON error body and status code
+    """
+    def __init__(self, message, status=400):
+        super(ApiError, self).__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=error.message), error.status
+
+def encode_cursor(total_bugs, tester_id):
+    # Opaque to clients, they only hand it back
+    return base64.urlsafe_b64encode("{}:{}".format(total_bugs, tester_id).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        total_bugs, tester_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(total_bugs), int(tester_id)
+    except ValueError:
+        raise ApiError("Invalid cursor")
+
+def parse_search(args):
+    """
+    Read the country and device ids of a search from request arguments
+
+    Args:
+      args: The request's query arguments
+    Returns:
+      Tuple of the country code and a sorted list of device ids
+    """
+    country = args.get("country", "ALL")
+    try:
+        devices = normalize_devices(d for d in args.get("devices", "").split(",") if d)
+    except ValueError:
+        raise ApiError("devices must be comma separated device ids")
+    if not devices:
+        raise ApiError("At least one device id is required")
+    return country, devices
+
+def result_json(row):
+    return {
+        "tester_id": row.tester_id,
+        "name": row.tester_name,
+        "total_bugs": row.total_bugs,
+        "devices": [{"device_id": e.device_id, "device_name": e.device_name, "bugs": e.bugs} for e in row.experiences],
+    }
+
+@app.route("/api/v1/match", methods=["GET"])
+@read_only
+def api_match():
+    """
+    Ranked testers for a search as JSON, paged with keyset cursors. The body
+    is streamed, fetching API_CHUNK_SIZE testers at a time, so even very large
+    pages are served in bounded memory.
+
+    Query args:
+      country:  Country code or ALL, ALL by default
+      devices:  Comma separated device ids
+      limit:    Number of testers in this page, up to API_MAX_LIMIT
+      cursor:   The next_cursor of the previous page, if any
+      engine:   sql or matrix, to pick the search engine over MATCH_ENGINE
+      match:    all or any, to rank the testers owning all or any of the
+                devices, including those without bugs on them
+    Returns:
+      {"country", "devices", "results": [...], "next_cursor"}, where
+      next_cursor is null on the last page
+    """
+    country, devices = parse_search(request.args)
+    limit = request.args.get("limit", app.config["API_DEFAULT_LIMIT"], type=int)
+    if limit < 1 or limit > app.config["API_MAX_LIMIT"]:
+        raise ApiError("limit must be between 1 and {}".format(app.config["API_MAX_LIMIT"]))
+    cursor = request.args.get("cursor")
+    after = decode_cursor(cursor) if cursor else None
+    match = request.args.get("match")
+    if match is not None and match not in MATCH_MODES:
+        raise ApiError("match must be one of {}".format(", ".join(MATCH_MODES)))
+
+    def generate():
+        yield '{{"country": {}, "devices": {}, "results": ['.format(json.dumps(country), json.dumps(devices))
+        sent = 0
+        last = None
+        if match:
+            chunks = [rank_owners(country, devices, match, limit=limit, after=after)]
+        elif use_match_index(request.args.get("engine")):
+            chunks = [match_index.rank_testers(country, devices, limit=limit, after=after)]
+        else:
+            chunks = iter_rankings(country, devices, limit=limit, after=after, chunk_size=app.config["API_CHUNK_SIZE"])
+        for chunk in chunks:
+            if not chunk:
+                break
+            for row in result_rows(chunk):
+                yield ("," if sent else "") + json.dumps(result_json(row))
+                sent += 1
+            last = chunk[-1]
+
+        # A full page might be followed by more testers, a short one is the end
+        next_cursor = encode_cursor(last.total_bugs, last.tester_id) if sent == limit else None
+        yield '], "next_cursor": {}}}'.format(json.dumps(next_cursor))
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+def export_response(headers, chunks, filename):
+    """
+    Stream rows as a csv or ndjson download, picked with the format argument,
+    gzipped when the client accepts it
+
+    Args:
+      headers:  Column names
+      chunks:   Iterable of lists of row tuples
+      filename: Download name without the extension
+    Returns:
+      The streamed response
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in FORMATS:
+        raise ApiError("format must be one of {}".format(", ".join(FORMATS)))
+    body = encode(headers, chunks, fmt)
+    gzip = request.accept_encodings["gzip"] > 0
+    if gzip:
+        body = gzipped(body)
+    response = Response(stream_with_context(body), mimetype="text/csv" if fmt == "csv" else "application/x-ndjson")
+    response.headers["Content-Disposition"] = "attachment; filename={}.{}".format(filename, fmt)
+    response.vary.add("Accept-Encoding")
+    if gzip:
+        response.content_encoding = "gzip"
+    return response
+
+@app.route("/api/v1/export/<name>", methods=["GET"])
+@read_only
+def api_export(name):
+    """
+    Download a whole table, streamed off one query in key order. bugs,
+    testers, devices and tester_device use the layout of the shipped csv
+    files, so the import-csv command can load them back.
+
+    Args:
+      name:     bugs, testers, devices, tester_device or experience
+    Query args:
+      format:   csv or ndjson, csv by default
+    """
+    target = TARGETS.get(name)
+    if target is None:
+        raise ApiError("Unknown table {}, expected one of {}".format(name, ", ".join(TARGETS)), 404)
+    return export_response(target.headers, table_rows(target, app.config["EXPORT_CHUNK_SIZE"]), name)
+
+@app.route("/api/v1/match/export", methods=["GET"])
+@read_only
+def api_match_export():
+    """
+    Download a whole search ranking, one row per tester with their bugs on
+    each device, streamed with keyset paging
+
+    Query args:
+      country:  Country code or ALL, ALL by default
+      devices:  Comma separated device ids
+      format:   csv or ndjson, csv by default
+    """
+    country, devices = parse_search(request.args)
+    return export_response(search_headers(devices), search_rows(country, devices, app.config["API_CHUNK_SIZE"]), "match")
+
+def parse_searches(items):
+    """
+    Read the searches of a multi search body
+
+    Args:
+      items:  List of {"country", "devices", "limit", "cursor"} objects, where
+              devices is a list or a comma separated string of device ids
+    Returns:
+      List of Search tuples, in the order given
+    """
+    searches = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ApiError("Search {}: expected an object".format(index))
+        devices = item.get("devices", "")
+        if isinstance(devices, list):
+            devices = ",".join(str(d) for d in devices)
+        try:
+            country, devices = parse_search({"country": item.get("country", "ALL"), "devices": str(devices)})
+            limit = item.get("limit", app.config["API_DEFAULT_LIMIT"])
+            if not isinstance(limit, int) or limit < 1 or limit > app.config["API_MAX_LIMIT"]:
+                raise ApiError("limit must be between 1 and {}".format(app.config["API_MAX_LIMIT"]))
+            after = decode_cursor(item["cursor"]) if item.get("cursor") else None
+        except ApiError as e:
+            raise ApiError("Search {}: {}".format(index, e.message))
+        searches.append(Search(country, tuple(devices), limit, after))
+    return searches
+
+@app.route("/api/v1/match/batch", methods=["POST"])
+@read_only
+def api_match_batch():
+    """
+    Run many searches in one request. Identical searches are run once, and
+    the distinct ones run at the same time on MULTI_SEARCH_WORKERS threads,
+    so the request takes about as long as its slowest search.
+
+    Body:
+      Either a list of searches, or {"searches": [...], "engine": "sql"}.
+      Each search is {"country", "devices", "limit", "cursor"} with the same
+      meaning as the arguments of /api/v1/match
+    Returns:
+      {"searches": [{"country", "devices", "results", "next_cursor",
+      "elapsed_ms"}], "distinct", "elapsed_ms"}, with the searches in the
+      order given
+    """
+    start = time.perf_counter()
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        items, engine = body.get("searches"), body.get("engine")
+    else:
+        items, engine = body, None
+    if not isinstance(items, list) or not items:
+        raise ApiError("Expected a JSON list of searches")
+    if len(items) > app.config["MULTI_SEARCH_MAX"]:
+        raise ApiError("At most {} searches per request".format(app.config["MULTI_SEARCH_MAX"]), 413)
+
+    searches = parse_searches(items)
+    done = run_searches(searches, engine=engine)
+    out = []
+    for search in searches:
+        result = done[search]
+        last = result.rows[-1] if result.rows else None
+        next_cursor = encode_cursor(last.total_bugs, last.tester_id) if len(result.rows) == search.limit else None
+        out.append({
+            "country": search.country,
+            "devices": list(search.devices),
+            "results": [result_json(row) for row in result.rows],
+            "next_cursor": next_cursor,
+            "elapsed_ms": round(result.elapsed_ms, 3),
+        })
+    return jsonify(searches=out, distinct=len(done), elapsed_ms=round((time.perf_counter() - start) * 1000, 3))
+
+def batch_json(results, atomic):
+    failed = sum(1 for r in results if r.error)
+    applied = 0 if atomic and failed else len(results) - failed
+    return {
+        "applied": applied,
+        "failed": failed,
+        "results": [{"index": r.index, "id": r.id, "error": r.error} for r in results],
+    }
+
+@app.route("/api/v1/batch", methods=["POST"])
+def api_batch():
+    """
+    Create, update and delete bugs, testers and devices in one transaction.
+    Referenced ids are checked with set based queries, and Experience gets
+    one summed update per tester/device pair, so thousands of bugs can be
+    filed per request.
+
+    Body:
+      Either a list of operations, or {"operations": [...], "atomic": bool}.
+      See app.batch.run_batch for the operation fields.
+    Returns:
+      {"applied", "failed", "results": [{"index", "id", "error"}]}. Invalid
+      operations are skipped, unless atomic is set, in which case nothing is
+      applied and the status is 422
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        items, atomic = body.get("operations"), bool(body.get("atomic"))
+    else:
+        items, atomic = body, False
+    if not isinstance(items, list):
+        raise ApiError("Expected a JSON list of operations")
+    if len(items) > app.config["BATCH_MAX_ITEMS"]:
+        raise ApiError("At most {} operations per batch".format(app.config["BATCH_MAX_ITEMS"]), 413)
+
+    results = run_batch(items, atomic=atomic)
+    body = batch_json(results, atomic)
+    return jsonify(body), 422 if atomic and body["failed"] else 200
+
+def change_json(entry):
+    c = entry.change
+    return {
+        "seq": entry.seq,
+        "table": c.table,
+        "op": c.op,
+        "key": c.key,
+        "old": c.old,
+        "new": c.new,
+        "created_at": entry.created_at.isoformat() + "Z",
+    }
+
+@app.route("/api/v1/changes", methods=["GET"])
+@read_only
+def api_changes():
+    """
+    Writes committed after a cursor, oldest first, for consumers keeping
+    their own copies up to date without rescanning the tables
+
+    Query args:
+      since:  seq of the last change already applied, 0 by default
+      limit:  Number of changes in this page, up to CHANGES_MAX_LIMIT
+    Returns:
+      {"changes": [{"seq", "table", "op", "key", "old", "new",
+      "created_at"}], "next_since", "latest"}, where next_since is the since
+      of the next page. Deleting a tester or device also logs the deletes
+      of its device links, and implies its bugs and Experience rows are
+      gone without logging them. A table "experience" op "rebuild" change
+      means reload everything. When changes after since were trimmed from the log,
+      the status is 410 with {"error", "reset": true, "latest"}: reload
+      everything and carry on from latest
+    """
+    since = request.args.get("since", 0, type=int)
+    limit = request.args.get("limit", app.config["API_DEFAULT_LIMIT"], type=int)
+    if since < 0:
+        raise ApiError("since must be a sequence number")
+    if limit < 1 or limit > app.config["CHANGES_MAX_LIMIT"]:
+        raise ApiError("limit must be between 1 and {}".format(app.config["CHANGES_MAX_LIMIT"]))
+    try:
+        changes = read_changes(since, limit)
+    except ChangesTrimmed as e:
+        return jsonify(error=str(e), reset=True, latest=latest_seq()), 410
+    return jsonify(changes=[change_json(e) for e in changes], next_since=changes[-1].seq if changes else since,
+        latest=latest_seq())
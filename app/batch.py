@@ -0,0 +1,330 @@
+from app import db
+from app.changes import Change, record
+from app.experience import apply_deltas
+from app.importer import chunked
+from app.models import association_table, Bug, Device, Tester
+from app.purge import purge_devices, purge_testers
+from collections import Counter, namedtuple
+from datetime import datetime
+from sqlalchemy import bindparam, func, select
+
+# One operation of a batch once its shape is checked: its position in the
+# request, "create", "update" or "delete", "bug", "tester" or "device", the
+# id it targets (optional for creates) and the remaining fields
+Operation = namedtuple("Operation", ["index", "op", "type", "id", "fields"])
+
+# Outcome of one operation: the id it created or changed, or why it was
+# rejected
+ItemResult = namedtuple("ItemResult", ["index", "id", "error"])
+
+OPS = ("create", "update", "delete")
+TYPES = ("bug", "tester", "device")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Order operations are checked and written in: parents are created before the
+# bugs that point at them, and deleted after them
+PHASES = [
+    ("create", "device"), ("update", "device"),
+    ("create", "tester"), ("update", "tester"),
+    ("create", "bug"), ("update", "bug"),
+    ("delete", "bug"), ("delete", "tester"), ("delete", "device"),
+]
+
+# Largest IN list sent in one statement
+LOOKUP_CHUNK = 500
+
+class InvalidItem(Exception):
+    """
+    An operation that cannot be applied, reported against its index
+    """
+
+def _int(value, field):
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+        raise InvalidItem("{} must be a positive integer".format(field))
+    return int(value)
+
+def _text(value, field, length):
+    if not isinstance(value, str) or not value.strip():
+        raise InvalidItem("{} is required".format(field))
+    if len(value) > length:
+        raise InvalidItem("{} is longer than {} characters".format(field, length))
+    return value
+
+def _parse(index, item):
+    # Check the shape of one raw operation and convert its fields
+    if not isinstance(item, dict):
+        raise InvalidItem("Operations must be objects")
+    op, kind = item.get("op"), item.get("type")
+    if op not in OPS:
+        raise InvalidItem("op must be one of " + ", ".join(OPS))
+    if kind not in TYPES:
+        raise InvalidItem("type must be one of " + ", ".join(TYPES))
+    id = item.get("id")
+    if id is not None or op != "create":
+        id = _int(id, "id")
+
+    fields = {}
+    if op == "delete":
+        return Operation(index, op, kind, id, fields)
+    required = op == "create"
+    if kind == "bug":
+        for f in ("tester_id", "device_id"):
+            if f in item or required:
+                fields[f] = _int(item.get(f), f)
+    elif kind == "device":
+        fields["device_name"] = _text(item.get("device_name"), "device_name", 64)
+    else:
+        for f, length in (("first_name", 64), ("last_name", 64), ("country", 2)):
+            if f in item or required:
+                fields[f] = _text(item.get(f), f, length)
+        if "last_login" in item or required:
+            try:
+                fields["last_login"] = datetime.strptime(item.get("last_login") or "", TIME_FORMAT)
+            except (TypeError, ValueError):
+                raise InvalidItem("last_login must look like 2013-08-04 23:57:38")
+        if "devices" in item or required:
+            devices = item.get("devices")
+            if not isinstance(devices, list):
+                raise InvalidItem("devices must be a list of device ids")
+            fields["devices"] = sorted({_int(d, "devices") for d in devices})
+    if op == "update" and not fields:
+        raise InvalidItem("Nothing to update")
+    return Operation(index, op, kind, id, fields)
+
+def _lookup(query, column, values):
+    # Run a query once per chunk of an IN list, collecting every row
+    rows = []
+    for chunk in chunked(sorted(values), LOOKUP_CHUNK):
+        rows.extend(db.session.execute(query.where(column.in_(chunk))))
+    return rows
+
+class Batch(object):
+    """
+    The database rows a batch refers to, loaded with one set based query per
+    table. The ids in known follow the batch's own operations as they are
+    checked, so later operations can refer to rows created earlier in it.
+    """
+    def __init__(self, operations):
+        device_ids, tester_ids, bug_ids, names = set(), set(), set(), set()
+        for o in operations:
+            {"device": device_ids, "tester": tester_ids, "bug": bug_ids}[o.type].add(o.id)
+            device_ids.add(o.fields.get("device_id"))
+            device_ids.update(o.fields.get("devices", ()))
+            tester_ids.add(o.fields.get("tester_id"))
+            names.add(o.fields.get("device_name"))
+        for ids in (device_ids, tester_ids, bug_ids, names):
+            ids.discard(None)
+
+        tracked = [Tester.__table__.c[c] for c in ("id", "first_name", "last_name", "country", "last_login")]
+        self.devices = dict(_lookup(select([Device.id, Device.device_name]), Device.id, device_ids))
+        self.testers = {r[0]: dict(r._mapping) for r in _lookup(select(tracked), Tester.id, tester_ids)}
+        self.bugs = {r[0]: (r[1], r[2]) for r in _lookup(select([Bug.id, Bug.tester_id, Bug.device_id]), Bug.id, bug_ids)}
+        self.names = dict(_lookup(select([Device.device_name, Device.id]), Device.device_name, names))
+        self.owned = {}
+        for tester_id, device_id in _lookup(select([association_table.c.tester_id, association_table.c.device_id]),
+                association_table.c.tester_id, tester_ids):
+            self.owned.setdefault(tester_id, set()).add(device_id)
+        self.known = {"device": set(self.devices), "tester": set(self.testers), "bug": set(self.bugs)}
+
+    def check(self, o):
+        """
+        Raise InvalidItem if the operation cannot be applied, otherwise
+        update the known rows as if it had been
+        """
+        known = self.known[o.type]
+        if o.op == "create" and o.id in known:
+            raise InvalidItem("{} {} already exists".format(o.type.capitalize(), o.id))
+        if o.op != "create" and o.id not in known:
+            raise InvalidItem("No {} with id {}".format(o.type, o.id))
+        for f in ("tester_id", "device_id"):
+            if f in o.fields and o.fields[f] not in self.known[f[:-3]]:
+                raise InvalidItem("No {} with id {}".format(f[:-3], o.fields[f]))
+        missing = [d for d in o.fields.get("devices", ()) if d not in self.known["device"]]
+        if missing:
+            raise InvalidItem("No device with id {}".format(missing[0]))
+
+        # Devices created without an id are told apart by their position
+        name = o.fields.get("device_name")
+        key = o.id if o.id is not None else ("new", o.index)
+        if name is not None and self.names.get(name, key) != key:
+            raise InvalidItem("A device named {} already exists".format(name))
+
+        if o.op == "delete":
+            known.discard(o.id)
+        elif o.id is not None:
+            known.add(o.id)
+        if name is not None:
+            self.names[name] = key
+
+def run_batch(items, atomic=False):
+    """
+    Apply a batch of bug, tester and device writes in a single transaction.
+    Referenced ids are checked with one query per table up front, bugs are
+    written with bulk statements, and the Experience counts get one summed
+    delta per tester/device pair.
+
+    Args:
+      items:  List of operation dicts, each with "op" (create, update or
+              delete), "type" (bug, tester or device), "id" (optional for
+              creates) and the fields to set: tester_id and device_id for
+              bugs, device_name for devices, first_name, last_name, country,
+              last_login and devices (replacing the tester's devices) for
+              testers
+      atomic: Apply nothing if any operation is invalid, instead of
+              skipping the invalid ones
+    Returns:
+      List of ItemResult, one per item in the same order
+    """
+    results = {}
+    operations = []
+    for index, item in enumerate(items):
+        try:
+            operations.append(_parse(index, item))
+        except InvalidItem as e:
+            results[index] = ItemResult(index, None, str(e))
+
+    # Each row may only be written once per batch, so the order items are
+    # written in never matters
+    seen = set()
+    for o in operations:
+        if o.id is not None and (o.type, o.id) in seen:
+            results[o.index] = ItemResult(o.index, o.id, "{} {} is already changed by this batch".format(o.type.capitalize(), o.id))
+        seen.add((o.type, o.id))
+    operations = [o for o in operations if o.index not in results]
+
+    batch = Batch(operations)
+    phases = {phase: [] for phase in PHASES}
+    for phase in PHASES:
+        for o in operations:
+            if (o.op, o.type) != phase:
+                continue
+            try:
+                batch.check(o)
+                phases[phase].append(o)
+            except InvalidItem as e:
+                results[o.index] = ItemResult(o.index, o.id, str(e))
+
+    if atomic and results:
+        return [results.get(i, ItemResult(i, None, "Not applied")) for i in range(len(items))]
+
+    try:
+        for o, id in _write(batch, phases):
+            results[o.index] = ItemResult(o.index, id, None)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return [results[i] for i in range(len(items))]
+
+def _insert_bugs(rows):
+    # Insert bugs without ids in one executemany and return an iterator over
+    # the ids they got, in order
+    if not rows:
+        return iter(())
+    bugs = Bug.__table__
+    connection = db.session.connection()
+    if connection.dialect.insert_executemany_returning:
+        return iter([r[0] for r in connection.execute(bugs.insert().returning(bugs.c.id), rows)])
+
+    # Otherwise number them after the highest id, as SQLite would. Writers
+    # are serialized, and an id taken in the meantime fails the insert on
+    # the primary key rather than being reused
+    start = connection.execute(select([func.coalesce(func.max(bugs.c.id), 0)])).scalar() + 1
+    connection.execute(bugs.insert(), [dict(r, id=start + i) for i, r in enumerate(rows)])
+    return iter(range(start, start + len(rows)))
+
+def _write(batch, phases):
+    # Apply checked operations in phase order, yielding each with its id
+    changes = []
+    deltas = Counter()
+    devices, testers, bugs = Device.__table__, Tester.__table__, Bug.__table__
+
+    for o in phases[("create", "device")]:
+        values = dict(o.fields, **({"id": o.id} if o.id is not None else {}))
+        id = db.session.execute(devices.insert().values(values)).inserted_primary_key[0]
+        changes.append(Change("device", "insert", id, None, o.fields))
+        yield o, id
+    for o in phases[("update", "device")]:
+        db.session.execute(devices.update().where(devices.c.id == o.id).values(o.fields))
+        changes.append(Change("device", "update", o.id, {"device_name": batch.devices[o.id]}, o.fields))
+        yield o, o.id
+
+    links, unlinks = [], []
+    for o in phases[("create", "tester")] + phases[("update", "tester")]:
+        values = {f: v for f, v in o.fields.items() if f != "devices"}
+        if o.op == "create":
+            if o.id is not None:
+                values["id"] = o.id
+            id = db.session.execute(testers.insert().values(values)).inserted_primary_key[0]
+            changes.append(Change("tester", "insert", id, None, {f: values[f] for f in values if f != "id"}))
+        else:
+            id = o.id
+            old = {f: v for f, v in batch.testers[id].items() if f != "id"}
+            if values:
+                db.session.execute(testers.update().where(testers.c.id == id).values(values))
+                changes.append(Change("tester", "update", id, old, dict(old, **values)))
+        if "devices" in o.fields:
+            owned = batch.owned.get(o.id, set())
+            links.extend((id, d) for d in o.fields["devices"] if d not in owned)
+            unlinks.extend((id, d) for d in owned if d not in o.fields["devices"])
+        yield o, id
+    if links:
+        db.session.execute(association_table.insert(), [{"tester_id": t, "device_id": d} for t, d in links])
+    for t, d in unlinks:
+        db.session.execute(association_table.delete().where(
+            (association_table.c.tester_id == t) & (association_table.c.device_id == d)))
+    # Touch the testers whose devices changed, like the ORM edit does, so
+    # their version and the tester page's ETag move
+    relinked = sorted({t for t, _ in links + unlinks})
+    for chunk in chunked(relinked, LOOKUP_CHUNK):
+        db.session.execute(testers.update().where(testers.c.id.in_(chunk)).values(updated_at=datetime.utcnow()))
+    changes.extend(Change("association", "insert", (t, d), None, {"tester_id": t, "device_id": d}) for t, d in links)
+    changes.extend(Change("association", "delete", (t, d), {"tester_id": t, "device_id": d}, None) for t, d in unlinks)
+
+    # Bugs are the bulk of a batch: one executemany per kind of write
+    created = phases[("create", "bug")]
+    rows = [dict(o.fields, id=o.id) for o in created if o.id is not None]
+    if rows:
+        db.session.execute(bugs.insert(), rows)
+    ids = _insert_bugs([o.fields for o in created if o.id is None])
+    for o in created:
+        id = o.id if o.id is not None else next(ids)
+        deltas[(o.fields["tester_id"], o.fields["device_id"])] += 1
+        changes.append(Change("bug", "insert", id, None, o.fields))
+        yield o, id
+
+    moves = []
+    for o in phases[("update", "bug")]:
+        old = dict(zip(("tester_id", "device_id"), batch.bugs[o.id]))
+        new = dict(old, **o.fields)
+        moves.append({"bug_id": o.id, "tester_id": new["tester_id"], "device_id": new["device_id"]})
+        deltas[(old["tester_id"], old["device_id"])] -= 1
+        deltas[(new["tester_id"], new["device_id"])] += 1
+        changes.append(Change("bug", "update", o.id, old, new))
+        yield o, o.id
+    if moves:
+        db.session.execute(bugs.update().where(bugs.c.id == bindparam("bug_id"))
+            .values(tester_id=bindparam("tester_id"), device_id=bindparam("device_id")), moves)
+
+    gone = [o.id for o in phases[("delete", "bug")]]
+    for chunk in chunked(gone, LOOKUP_CHUNK):
+        db.session.execute(bugs.delete().where(bugs.c.id.in_(chunk)))
+    for o in phases[("delete", "bug")]:
+        tester_id, device_id = batch.bugs[o.id]
+        deltas[(tester_id, device_id)] -= 1
+        changes.append(Change("bug", "delete", o.id, {"tester_id": tester_id, "device_id": device_id}, None))
+        yield o, o.id
+
+    # The counts and changes so far go in before testers and devices are
+    # deleted, since those take their bugs, device links and Experience rows
+    # with them
+    apply_deltas(db.session.connection(), deltas)
+    record(changes)
+    for chunk in chunked([o.id for o in phases[("delete", "tester")]], LOOKUP_CHUNK):
+        purge_testers(testers.c.id.in_(chunk))
+    for o in phases[("delete", "tester")]:
+        yield o, o.id
+    for chunk in chunked([o.id for o in phases[("delete", "device")]], LOOKUP_CHUNK):
+        purge_devices(devices.c.id.in_(chunk))
+    for o in phases[("delete", "device")]:
+        yield o, o.id
@@ -0,0 +1,220 @@
+import json
+import pickle
+import sqlite3
+import threading
+import time
+
+from app import app
+from app.changes import data_changed
+from app.ranking import normalize_devices, rank_testers
+from app.versions import GenerationWatch
+from collections import OrderedDict
+
+class MemoryBackend(object):
+    """
+    Bounded in process store, evicting the least recently used key once full
+    and dropping keys older than ttl seconds when they are read
+    """
+    shared = False
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SqliteBackend(object):
+    """
+    Store kept in a local sqlite file, so several worker processes on one
+    machine share entries and invalidations. Same interface and limits as
+    MemoryBackend.
+    """
+    shared = True
+
+    def __init__(self, path, maxsize, ttl):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_search_cache_used ON search_cache (used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        key = json.dumps(key)
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE search_cache SET used = ? WHERE key = ?", (now, key))
+            return pickle.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?)", (json.dumps(key), pickle.dumps(value), now + self.ttl, now))
+            conn.execute("DELETE FROM search_cache WHERE key IN (SELECT key FROM search_cache ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM search_cache WHERE key = ?", (json.dumps(key),))
+
+    def keys(self):
+        with self._connect() as conn:
+            return [tuple(json.loads(k)) for k, in conn.execute("SELECT key FROM search_cache")]
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM search_cache")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+class SearchCache(object):
+    """
+    Cache of search rankings. Each entry is keyed by the normalized (country,
+    device ids) of a search and holds every page of it asked for so far, so
+    one write invalidates all pages of a search together.
+
+    Writes drop the searches they change in the process that made them, and
+    in a shared backend for every process. An unshared backend is also
+    cleared once the rankings' generation counters show writes from other
+    processes.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+        # Bumped by every invalidation, so a ranking computed while a write
+        # was committing is not stored after that write invalidated it
+        self._generation = 0
+        self._watch = GenerationWatch("bug", "tester", "experience", "device-deletes")
+
+    @staticmethod
+    def key(country, devices):
+        return (country,) + tuple(normalize_devices(devices))
+
+    def rank_testers(self, country, devices, limit=None, offset=0):
+        """
+        Same as app.ranking.rank_testers, answered from the cache when possible
+        """
+        if not self.backend.shared:
+            values = self._watch.read()
+            if values != self._watch.seen:
+                self.clear()
+                self._watch.loaded(values)
+        key = self.key(country, devices)
+        page = "{}:{}".format(limit, offset)
+        entry = self.backend.get(key) or {}
+        if page in entry:
+            self.hits += 1
+            return entry[page]
+        self.misses += 1
+        generation = self._generation
+        entry[page] = rank_testers(country, devices, limit=limit, offset=offset)
+        if generation == self._generation:
+            self.backend.set(key, entry)
+        return entry[page]
+
+    def invalidate(self, countries=(), devices=()):
+        """
+        Drop the searches in any of the countries, or including any of the
+        devices. ALL in countries only drops the ALL searches.
+        """
+        self._generation += 1
+        countries = set(countries)
+        devices = set(devices)
+        for key in self.backend.keys():
+            if key[0] in countries or devices.intersection(key[1:]):
+                self.backend.delete(key)
+
+    def clear(self):
+        self._generation += 1
+        self.backend.clear()
+
+    def follow(self):
+        """
+        Returns:
+          False when the backend missed writes of other processes and has
+          to be cleared rather than have this process's commit invalidated
+        """
+        return self.backend.shared or self._watch.follow()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "size": len(self.backend)}
+
+def make_backend(config):
+    if config["SEARCH_CACHE_PATH"]:
+        return SqliteBackend(config["SEARCH_CACHE_PATH"], config["SEARCH_CACHE_SIZE"], config["SEARCH_CACHE_TTL"])
+    return MemoryBackend(config["SEARCH_CACHE_SIZE"], config["SEARCH_CACHE_TTL"])
+
+search_cache = SearchCache(make_backend(app.config))
+
+@data_changed.connect_via(app)
+def _invalidate(sender, changes):
+    if not search_cache.follow():
+        search_cache.clear()
+        return
+    countries = set()
+    devices = set()
+    for c in changes:
+        if c.table == "experience" and c.op == "rebuild":
+            search_cache.clear()
+            return
+        if c.table == "bug":
+            # A bug only moves the counts on its own device(s)
+            devices.update(v["device_id"] for v in (c.old, c.new) if v)
+        elif c.table == "tester":
+            # Moving country changes both countries' rankings, removing a
+            # tester changes every ranking they were in
+            if c.op == "update" and c.old["country"] != c.new["country"]:
+                countries.update((c.old["country"], c.new["country"]))
+            elif c.op == "delete":
+                countries.update((c.old["country"], "ALL"))
+        elif c.table == "device" and c.op == "delete":
+            devices.add(c.key)
+    if countries or devices:
+        search_cache.invalidate(countries, devices)
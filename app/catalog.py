@@ -0,0 +1,54 @@
+import threading
+import time
+
+from app import app, db
+from app.changes import data_changed
+from app.models import Device
+from app.versions import GenerationWatch
+
+class DeviceCatalog(object):
+    """
+    In memory map of device id to device name. It is loaded on first use
+    rather than at import, and reloaded after this process commits a device
+    write, once the device generation shows writes from other worker
+    processes, and at least every ttl seconds.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._names = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+        self._watch = GenerationWatch("device")
+
+    def names(self):
+        """
+        Returns:
+          Dict of device id to device name, in id order
+        """
+        names = self._names
+        values = self._watch.read()
+        if names is None or values != self._watch.seen or time.monotonic() - self._loaded > self.ttl:
+            with self._lock:
+                names = dict(db.session.query(Device.id, Device.device_name).order_by(Device.id))
+                self._names = names
+                self._loaded = time.monotonic()
+                self._watch.loaded(values)
+        return names
+
+    def choices(self):
+        """
+        Returns:
+          List of (device id, device name) pairs for select fields
+        """
+        return list(self.names().items())
+
+    def refresh(self):
+        # Drop the map, the next lookup loads it again
+        self._names = None
+
+device_catalog = DeviceCatalog(app.config["DEVICE_CATALOG_TTL"])
+
+@data_changed.connect_via(app)
+def _refresh(sender, changes):
+    if any(c.table == "device" for c in changes):
+        device_catalog.refresh()
@@ -0,0 +1,151 @@
+import json
+import threading
+
+from app import app, db
+from app.changes import Change, changes_recorded
+from app.models import ChangeLog
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import and_, func, select
+
+# Every Change recorded by a write is also appended to the change_log table,
+# in the same transaction, so the log holds exactly the committed writes in
+# the order they were made. Consumers in other processes (caches, indexes,
+# replicas) keep a cursor, the seq of the last change they applied, and read
+# what came after it instead of rescanning the tables. An experience
+# "rebuild" change tells them to start over. SQLite serializes writers, so
+# sequence numbers also come in commit order.
+
+# A change read back from the log, with its sequence number and the time it
+# was written. Times in old/new come back as "%Y-%m-%d %H:%M:%S" strings
+LoggedChange = namedtuple("LoggedChange", ["seq", "created_at", "change"])
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+class ChangesTrimmed(Exception):
+    """
+    The changes after a cursor were partly trimmed from the log, so the
+    consumer has to reload the tables and carry on from latest_seq()
+    """
+
+def _json(value):
+    if value is None:
+        return None
+    return json.dumps(value, default=lambda v: v.strftime(TIME_FORMAT) if isinstance(v, datetime) else str(v))
+
+def _key(table, text):
+    # Association keys are (tester_id, device_id) pairs, the rest row ids
+    key = json.loads(text) if text is not None else None
+    return tuple(key) if table == "association" and key is not None else key
+
+@changes_recorded.connect
+def _append(session, changes):
+    if not app.config["CHANGE_LOG_ENABLED"]:
+        return
+    now = datetime.utcnow()
+    session.connection().execute(ChangeLog.__table__.insert(), [{
+        "table_name": c.table, "op": c.op, "key": _json(c.key), "old": _json(c.old), "new": _json(c.new), "created_at": now,
+    } for c in changes])
+
+def read_changes(since=0, limit=500):
+    """
+    Changes committed after a cursor, oldest first
+
+    Args:
+      since:  seq of the last change already applied, 0 for the start
+      limit:  Most changes to return
+    Returns:
+      List of LoggedChange
+    Raises:
+      ChangesTrimmed when changes right after since are no longer logged
+    """
+    log = ChangeLog.__table__
+    oldest = db.session.execute(select([func.min(log.c.seq)])).scalar()
+    if oldest is not None and since < oldest - 1:
+        raise ChangesTrimmed("Changes after {} were trimmed, the oldest kept is {}".format(since, oldest))
+    rows = db.session.execute(select([log]).where(log.c.seq > since).order_by(log.c.seq).limit(limit))
+    return [LoggedChange(r.seq, r.created_at, Change(r.table_name, r.op, _key(r.table_name, r.key),
+        json.loads(r.old) if r.old else None, json.loads(r.new) if r.new else None)) for r in rows]
+
+def latest_seq():
+    """
+    Returns:
+      seq of the newest change in the log, 0 when it is empty
+    """
+    return db.session.execute(select([func.coalesce(func.max(ChangeLog.seq), 0)])).scalar()
+
+def trim_changes(before):
+    """
+    Drop changes written before a time, for consumers to have caught up by.
+    The newest change is always kept, so consumers whose cursor is older
+    than every kept change can be told apart. Runs in the current
+    transaction, the caller commits.
+
+    Args:
+      before: datetime in UTC
+    Returns:
+      Number of changes dropped
+    """
+    log = ChangeLog.__table__
+    newest = select([func.max(log.c.seq)]).scalar_subquery()
+    return db.session.execute(log.delete().where(and_(log.c.created_at < before, log.c.seq < newest))).rowcount
+
+class ChangeSubscriber(object):
+    """
+    Follows the change log from a cursor, handing changes to a callback in
+    batches of up to batch_size. The cursor only moves past a batch once the
+    callback returns, so a failing callback sees the same batch again.
+
+    When the changes after the cursor were trimmed, on_reset is called to
+    reload everything, and the subscriber carries on from the newest change
+    logged before it was called. Without on_reset, ChangesTrimmed is raised.
+
+    Example:
+      subscriber = ChangeSubscriber(lambda batch: index.apply(batch), since=saved_seq)
+      subscriber.run()
+    """
+    def __init__(self, handler, since=0, batch_size=500, on_reset=None):
+        self.handler = handler
+        self.on_reset = on_reset
+        self.since = since
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def poll(self):
+        """
+        Apply the next batch, if any. Needs an app context whose session has
+        nothing pending, since the read transaction is ended so the next poll
+        sees newer commits.
+
+        Returns:
+          Number of changes handed to the callback
+        """
+        try:
+            batch = read_changes(self.since, self.batch_size)
+        except ChangesTrimmed:
+            latest = latest_seq()
+            db.session.rollback()
+            if self.on_reset is None:
+                raise
+            self.on_reset()
+            self.since = latest
+            return 0
+        db.session.rollback()
+        if batch:
+            self.handler(batch)
+            self.since = batch[-1].seq
+        return len(batch)
+
+    def run(self, interval=1.0):
+        """
+        Poll in an app context of its own until stop() is called, e.g. from
+        a thread, catching up in full batches and waiting interval seconds
+        whenever the log has been read to the end
+        """
+        with app.app_context():
+            while not self.stopped.is_set():
+                if self.poll() < self.batch_size:
+                    self.stopped.wait(interval)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,112 @@
+from app import app, db
+from app.models import Bug, Device, Tester
+from collections import namedtuple
+from flask.signals import Namespace
+from sqlalchemy import event, inspect
+
+# Everything derived from the tables (caches, indexes, rollups) learns about
+# writes through the data_changed signal. Changes are collected while the
+# session flushes and sent once the transaction commits, so listeners never
+# see writes that were rolled back. Listeners must not query the database
+# from the signal, everything they need is in the Change rows.
+_signals = Namespace()
+data_changed = _signals.signal("data-changed")
+
+# Sent by record() inside the writing transaction, before it commits, for
+# listeners that keep rows in step with the writes (the sender is the
+# session). They may write through session.connection(), but must not flush.
+changes_recorded = _signals.signal("changes-recorded")
+
+# One row touched by a write. table is "bug", "tester", "device",
+# "association" or "experience", op is "insert", "update" or "delete", and
+# old/new hold the tracked column values before and after (None for the side
+# that does not exist). A "rebuild" op on experience means bulk changes that
+# are not itemized, so listeners should start over.
+Change = namedtuple("Change", ["table", "op", "key", "old", "new"])
+
+# Columns each listener may care about, per model
+TRACKED = {
+    Bug: ("tester_id", "device_id"),
+    Tester: ("first_name", "last_name", "country", "last_login"),
+    Device: ("device_name",),
+}
+
+def record(changes, session=None):
+    """
+    Queue changes made outside the ORM, e.g. with core bulk statements, so they
+    are sent along with the session's own changes when it commits
+
+    Args:
+      changes:  Iterable of Change rows
+      session:  The session doing the writes, db.session by default
+    """
+    session = session or db.session()
+    changes = list(changes)
+    if changes:
+        session.info.setdefault("changes", []).extend(changes)
+        changes_recorded.send(session, changes=changes)
+
+def _values(obj, columns):
+    return {c: getattr(obj, c) for c in columns}
+
+def _old_values(state, columns):
+    # The value a column had when loaded, or its current one if unchanged
+    old = {}
+    for c in columns:
+        history = state.attrs[c].history
+        old[c] = history.deleted[0] if history.deleted else state.dict.get(c)
+    return old
+
+def _association_changes(state):
+    # Devices added to or removed from a tester's collection
+    if "devices" not in state.dict:
+        return []
+    history = state.attrs.devices.history
+    tester_id = state.obj().id
+    return [Change("association", "insert", (tester_id, d.id), None, {"tester_id": tester_id, "device_id": d.id}) for d in history.added] + \
+        [Change("association", "delete", (tester_id, d.id), {"tester_id": tester_id, "device_id": d.id}, None) for d in history.deleted]
+
+@event.listens_for(db.session, "after_flush")
+def _collect(session, flush_context):
+    changes = []
+    for obj in session.new:
+        columns = TRACKED.get(type(obj))
+        if columns:
+            changes.append(Change(obj.__tablename__, "insert", obj.id, None, _values(obj, columns)))
+    for obj in session.dirty:
+        columns = TRACKED.get(type(obj))
+        if not columns:
+            continue
+        state = inspect(obj)
+        old = _old_values(state, columns)
+        new = _values(obj, columns)
+        if old != new:
+            changes.append(Change(obj.__tablename__, "update", obj.id, old, new))
+    for obj in session.deleted:
+        columns = TRACKED.get(type(obj))
+        if columns:
+            changes.append(Change(obj.__tablename__, "delete", obj.id, _values(obj, columns), None))
+
+    # Collections of testers that were added, edited or deleted
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Tester):
+            changes.extend(_association_changes(inspect(obj)))
+    record(changes, session)
+
+@event.listens_for(db.session, "after_commit")
+def _dispatch(session):
+    changes = session.info.pop("changes", None)
+    if not changes:
+        return
+
+    # The data is already committed, so a failing listener is logged rather
+    # than failing the request, and the other listeners still run
+    for receiver in data_changed.receivers_for(app):
+        try:
+            receiver(app, changes=changes)
+        except Exception:
+            app.logger.exception("data_changed listener %r failed", receiver)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard(session):
+    session.info.pop("changes", None)
@@ -0,0 +1,203 @@
+import click
+import json
+import random
+import time
+
+from app import app, db
+from app.batch import run_batch
+from app.changelog import trim_changes
+from app.experience import rebuild_experience, verify_experience
+from app.exporter import encode, FORMATS, gzipped, search_headers, search_rows, table_rows, TARGETS
+from app.importer import import_csv
+from app.leaderboard import rebuild_leaderboards
+from app.matrix import match_index
+from app.models import Bug, Device, Tester
+from app.purge import purge_bugs, purge_devices, purge_testers
+from app.ranking import normalize_devices, rank_testers
+from config import basedir
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+
+@app.cli.command("import-csv")
+@click.option("--directory", default=basedir, show_default=True, help="Folder holding the csv files.")
+@click.option("--chunk-size", default=10000, show_default=True, help="Rows per bulk insert.")
+@click.option("--replace", is_flag=True, help="Empty the tables before loading.")
+def import_csv_command(directory, chunk_size, replace):
+    """
+    Bulk load testers.csv, devices.csv, tester_device.csv and bugs.csv, then
+    derive the Experience counts from the bugs.
+    """
+    for stats in import_csv(directory, chunk_size=chunk_size, replace=replace):
+        rate = stats.rows / stats.seconds if stats.seconds else 0
+        click.echo("{}: {} rows in {:.2f}s ({:.0f} rows/s)".format(stats.filename, stats.rows, stats.seconds, rate))
+
+@app.cli.command("export")
+@click.argument("name", type=click.Choice(sorted(TARGETS) + ["match"]))
+@click.option("--format", "fmt", type=click.Choice(FORMATS), default="csv", show_default=True)
+@click.option("--output", "-o", default="-", help="File to write, stdout by default.")
+@click.option("--gzip", is_flag=True, help="Gzip the output.")
+@click.option("--country", default="ALL", show_default=True, help="Country of the match export.")
+@click.option("--devices", default="", help="Comma separated device ids of the match export.")
+def export_command(name, fmt, output, gzip, country, devices):
+    """
+    Stream a table (bugs, testers, devices, tester_device, experience) or a
+    whole search ranking (match) as csv or ndjson, in bounded memory.
+    """
+    if name == "match":
+        try:
+            devices = normalize_devices(d for d in devices.split(",") if d)
+        except ValueError:
+            raise click.ClickException("--devices must be comma separated device ids")
+        if not devices:
+            raise click.ClickException("A match export needs --devices")
+        body = encode(search_headers(devices), search_rows(country, devices, app.config["API_CHUNK_SIZE"]), fmt)
+    else:
+        body = encode(TARGETS[name].headers, table_rows(TARGETS[name], app.config["EXPORT_CHUNK_SIZE"]), fmt)
+    body = gzipped(body) if gzip else (piece.encode() for piece in body)
+    with click.open_file(output, "wb") as f:
+        for data in body:
+            f.write(data)
+
+@app.cli.command("batch")
+@click.argument("file", type=click.File("r"))
+@click.option("--atomic", is_flag=True, help="Apply nothing if any operation is invalid.")
+def batch_command(file, atomic):
+    """
+    Apply a JSON list of bug, tester and device operations from FILE (- for
+    stdin) in one transaction, like POST /api/v1/batch.
+    """
+    try:
+        items = json.load(file)
+    except ValueError as e:
+        raise click.ClickException("Not valid JSON: {}".format(e))
+    if isinstance(items, dict):
+        items = items.get("operations")
+    if not isinstance(items, list):
+        raise click.ClickException("Expected a JSON list of operations")
+    results = run_batch(items, atomic=atomic)
+    failed = [r for r in results if r.error]
+    for r in failed:
+        click.echo("Operation {}: {}".format(r.index, r.error))
+    applied = 0 if atomic and failed else len(results) - len(failed)
+    click.echo("{} operations applied, {} failed".format(applied, len(failed)))
+    if failed:
+        raise SystemExit(1)
+
+def _ids(value):
+    try:
+        return [int(i) for i in value.split(",") if i]
+    except ValueError:
+        raise click.ClickException("--ids must be comma separated ids")
+
+@app.cli.command("purge")
+@click.argument("kind", type=click.Choice(["bugs", "testers", "devices"]))
+@click.option("--ids", default="", help="Comma separated ids to delete.")
+@click.option("--device", "device_ids", type=int, multiple=True, help="Bugs filed on this device, may be repeated.")
+@click.option("--not-updated-since", type=click.DateTime(), help="Bugs last written before this date.")
+@click.option("--not-seen-since", type=click.DateTime(), help="Testers last logged in before this date.")
+@click.option("--country", help="Testers from this country.")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted, then roll back.")
+def purge_command(kind, ids, device_ids, not_updated_since, not_seen_since, country, dry_run):
+    """
+    Delete bugs, testers or devices matching every given filter in one
+    transaction, with the bugs, device links and Experience rows that go with
+    them, and report the rows removed.
+    """
+    filters = []
+    ids = _ids(ids)
+    if kind == "bugs":
+        if ids:
+            filters.append(Bug.id.in_(ids))
+        if device_ids:
+            filters.append(Bug.device_id.in_(device_ids))
+        if not_updated_since:
+            filters.append(Bug.updated_at < not_updated_since)
+    elif kind == "testers":
+        if ids:
+            filters.append(Tester.id.in_(ids))
+        if not_seen_since:
+            filters.append(Tester.last_login < not_seen_since)
+        if country:
+            filters.append(Tester.country == country)
+    elif ids:
+        filters.append(Device.id.in_(ids))
+    if not filters:
+        raise click.ClickException("Give at least one filter that applies to {}".format(kind))
+
+    purge = {"bugs": purge_bugs, "testers": purge_testers, "devices": purge_devices}[kind]
+    start = time.perf_counter()
+    try:
+        stats = purge(and_(*filters))
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    click.echo("{} {} bugs, {} testers, {} devices, {} device links and {} experience rows in {:.2f}s".format(
+        "Would delete" if dry_run else "Deleted", stats.bugs, stats.testers, stats.devices, stats.associations,
+        stats.experience, time.perf_counter() - start))
+
+@app.cli.command("trim-changes")
+@click.option("--days", type=int, help="Days of changes to keep, CHANGE_LOG_RETENTION_DAYS by default.")
+def trim_changes_command(days):
+    """
+    Drop changes older than the retention period from the change log.
+    """
+    days = app.config["CHANGE_LOG_RETENTION_DAYS"] if days is None else days
+    rows = trim_changes(datetime.utcnow() - timedelta(days=days))
+    db.session.commit()
+    click.echo("Dropped {} changes".format(rows))
+
+@app.cli.command("rebuild-experience")
+@click.option("--verify", is_flag=True, help="Only report counts that drifted from the bugs table.")
+def rebuild_experience_command(verify):
+    """
+    Recompute the Experience counts from the bugs table in one GROUP BY pass.
+    """
+    if verify:
+        drift = verify_experience()
+        for d in drift:
+            click.echo("Tester {} on device {}: stored {}, actual {}".format(d.tester_id, d.device_id, d.stored, d.actual))
+        click.echo("{} experience rows drifted".format(len(drift)))
+        if drift:
+            raise SystemExit(1)
+        return
+    rows = rebuild_experience()
+    db.session.commit()
+    click.echo("Rebuilt {} experience rows".format(rows))
+
+@app.cli.command("rebuild-leaderboards")
+def rebuild_leaderboards_command():
+    """
+    Recompute the per country and device leaderboards from Experience.
+    """
+    rows = rebuild_leaderboards()
+    db.session.commit()
+    click.echo("Rebuilt {} leaderboard rows".format(rows))
+
+@app.cli.command("check-match-index")
+@click.option("--searches", default=100, show_default=True, help="Number of random searches to compare.")
+@click.option("--limit", default=50, show_default=True, help="Testers compared per search.")
+def check_match_index_command(searches, limit):
+    """
+    Compare the in memory match index with the SQL ranking on random searches.
+    """
+    if not match_index.available():
+        raise click.ClickException("The match index needs numpy")
+    countries = ["ALL"] + [c for c, in db.session.query(Tester.country).distinct()]
+    devices = [d for d, in db.session.query(Device.id)]
+    if not devices:
+        raise click.ClickException("There are no devices to search")
+    match_index.build()
+    mismatches = 0
+    for _ in range(searches):
+        country = random.choice(countries)
+        chosen = random.sample(devices, random.randint(1, min(5, len(devices))))
+        if rank_testers(country, chosen, limit=limit) != match_index.rank_testers(country, chosen, limit=limit):
+            mismatches += 1
+            click.echo("Mismatch for {} {}".format(country, chosen))
+    click.echo("{} of {} searches differ".format(mismatches, searches))
+    if mismatches:
+        raise SystemExit(1)
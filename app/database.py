@@ -0,0 +1,85 @@
+import functools
+import sqlite3
+
+from flask import g, has_app_context
+from flask_sqlalchemy import get_state, SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+
+# Bind key of the read only engine, set up when DATABASE_READ_URL is given
+READ_BIND = "read"
+
+def engine_options(config):
+    """
+    Engine arguments for SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings
+
+    Args:
+      config: The app's config
+    Returns:
+      Dict of create_engine keyword arguments
+    """
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    # SQLite files get a NullPool from Flask-SQLAlchemy, which takes no sizes
+    if not config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        options.update(
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+        )
+    return options
+
+def configure(app):
+    """
+    Fill in the engine options and read bind from the app's config, before
+    the SQLAlchemy extension is created
+    """
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
+    if app.config["DATABASE_READ_URL"]:
+        app.config.setdefault("SQLALCHEMY_BINDS", {})[READ_BIND] = app.config["DATABASE_READ_URL"]
+
+    @event.listens_for(Engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers carry on while a writer commits, and busy_timeout
+        # makes writers wait for the lock instead of failing straight away
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        if app.config["SQLITE_WAL"]:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout={:d}".format(app.config["SQLITE_BUSY_TIMEOUT"]))
+        cursor.execute("PRAGMA synchronous={}".format(app.config["SQLITE_SYNCHRONOUS"]))
+        if app.config["SQLITE_FOREIGN_KEYS"]:
+            cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+def read_only(view):
+    """
+    Mark a view as only reading, so its queries go to the read engine when
+    DATABASE_READ_URL is set. Code outside views can set g.read_only in its
+    own app context to the same effect. Anything it flushes still goes to the primary.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the queries of read only views to the read engine, and
+    everything else to the primary database
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_app_context() and g.get("read_only"):
+            state = get_state(self.app)
+            if READ_BIND in (self.app.config.get("SQLALCHEMY_BINDS") or {}):
+                return state.db.get_engine(self.app, bind=READ_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy whose sessions are RoutingSessions
+    """
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
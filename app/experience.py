@@ -0,0 +1,127 @@
+import sqlite3
+
+from app import db
+from app.changes import Change, record
+from app.leaderboard import update_leaderboards
+from app.models import Bug, Experience
+from collections import Counter, namedtuple
+from sqlalchemy import and_, event, func, inspect, literal, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+# Experience is a materialized aggregate of Bug: one row per tester/device
+# pair holding the number of bugs that tester filed on that device. It is
+# kept up to date by the mapper events below, inside the same transaction as
+# the bug write, and can be recomputed wholesale with rebuild_experience().
+
+# One tester/device pair whose stored count does not match the bugs table
+Drift = namedtuple("Drift", ["tester_id", "device_id", "stored", "actual"])
+
+def _upsert(dialect, table):
+    # INSERT that adds to the count of an existing pair instead of failing on
+    # uq_experience_tester_device, for the databases that have one
+    if dialect.name == "sqlite" and sqlite3.sqlite_version_info >= (3, 24, 0):
+        stmt = sqlite.insert(table)
+    elif dialect.name == "postgresql":
+        stmt = postgresql.insert(table)
+    elif dialect.name == "mysql":
+        stmt = mysql.insert(table)
+        return stmt.on_duplicate_key_update(bugs=table.c.bugs + stmt.inserted.bugs)
+    else:
+        return None
+    return stmt.on_conflict_do_update(index_elements=[table.c.tester_id, table.c.device_id],
+        set_={"bugs": table.c.bugs + stmt.excluded.bugs})
+
+def apply_deltas(connection, deltas):
+    """
+    Add bug count changes to Experience with atomic SQL increments, so
+    concurrent writers never overwrite each other's counts. The first bugs
+    of a pair are inserted with an upsert, so two writers filing them at
+    once both count instead of one failing on the unique pair.
+
+    Args:
+      connection: The connection of the transaction doing the bug writes
+      deltas:     Dict of (tester_id, device_id) to the change in bugs
+    """
+    table = Experience.__table__
+    upsert = _upsert(connection.dialect, table)
+    added = []
+    for (tester_id, device_id), delta in deltas.items():
+        if not delta:
+            continue
+        # NULL ids never conflict, so those pairs are always updated in place
+        if delta > 0 and upsert is not None and tester_id is not None and device_id is not None:
+            added.append({"tester_id": tester_id, "device_id": device_id, "bugs": delta})
+            continue
+        result = connection.execute(
+            table.update()
+            .where(and_(table.c.tester_id == tester_id, table.c.device_id == device_id))
+            .values(bugs=table.c.bugs + delta))
+
+        # First bug for this pair, so there is nothing to increment yet
+        if result.rowcount == 0 and delta > 0:
+            connection.execute(table.insert().values(tester_id=tester_id, device_id=device_id, bugs=delta))
+    if added:
+        connection.execute(upsert, added)
+
+    # The leaderboards follow in the same transaction
+    update_leaderboards(connection, [pair for pair, delta in deltas.items() if delta])
+
+@event.listens_for(Bug, "after_insert")
+def _bug_inserted(mapper, connection, target):
+    apply_deltas(connection, {(target.tester_id, target.device_id): 1})
+
+@event.listens_for(Bug, "after_delete")
+def _bug_deleted(mapper, connection, target):
+    apply_deltas(connection, {(target.tester_id, target.device_id): -1})
+
+@event.listens_for(Bug, "after_update")
+def _bug_updated(mapper, connection, target):
+    # Move the bug from the pair it used to count towards to its new one
+    state = inspect(target)
+    tester = state.attrs.tester_id.history
+    device = state.attrs.device_id.history
+    if not (tester.has_changes() or device.has_changes()):
+        return
+    old_tester = tester.deleted[0] if tester.deleted else target.tester_id
+    old_device = device.deleted[0] if device.deleted else target.device_id
+    deltas = Counter()
+    deltas[(old_tester, old_device)] -= 1
+    deltas[(target.tester_id, target.device_id)] += 1
+    apply_deltas(connection, deltas)
+
+def rebuild_experience():
+    """
+    Recompute every Experience row from the bugs table in a single aggregate
+    INSERT ... SELECT. Runs in the current session's transaction, the caller
+    commits.
+
+    Returns:
+      Number of Experience rows written
+    """
+    table = Experience.__table__
+    counts = select([Bug.tester_id, Bug.device_id, func.count(Bug.id)]).group_by(Bug.tester_id, Bug.device_id)
+    db.session.execute(table.delete())
+    result = db.session.execute(table.insert().from_select(["tester_id", "device_id", "bugs"], counts))
+    record([Change("experience", "rebuild", None, None, None)])
+    return result.rowcount
+
+def verify_experience():
+    """
+    Compare the stored Experience counts with the bugs table
+
+    Returns:
+      List of Drift rows, empty when Experience is correct
+    """
+    table = Experience.__table__
+    actual = select([Bug.tester_id, Bug.device_id, func.count(Bug.id).label("bugs")]) \
+        .group_by(Bug.tester_id, Bug.device_id).subquery()
+    joined = and_(table.c.tester_id == actual.c.tester_id, table.c.device_id == actual.c.device_id)
+
+    # Stored rows that are wrong, then pairs with bugs but no stored row
+    wrong = select([table.c.tester_id, table.c.device_id, table.c.bugs, func.coalesce(actual.c.bugs, 0)]) \
+        .select_from(table.outerjoin(actual, joined)) \
+        .where(func.coalesce(table.c.bugs, 0) != func.coalesce(actual.c.bugs, 0))
+    missing = select([actual.c.tester_id, actual.c.device_id, literal(None), actual.c.bugs]) \
+        .select_from(actual.outerjoin(table, joined)) \
+        .where(table.c.id.is_(None))
+    return [Drift(*row) for q in (wrong, missing) for row in db.session.execute(q)]
@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+import zlib
+
+from app import db
+from app.models import association_table, Bug, Device, Experience, Tester
+from app.ranking import iter_rankings, normalize_devices
+from app.viewmodels import result_rows
+from collections import namedtuple
+from sqlalchemy import select
+
+# How a table is written out: the export name, its csv headers and the
+# columns they come from, in the layout of the shipped csv files where there
+# is one, the key order rows are read in, and an optional function turning
+# one row into the values to write
+CsvTarget = namedtuple("CsvTarget", ["name", "headers", "columns", "order_by", "convert"])
+
+FORMATS = ("csv", "ndjson")
+
+def _login_time(value):
+    # Same format as testers.csv, which the importer reads back. SQLite rows
+    # read off the driver hold the stored text.
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value[:19]
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+TARGETS = {t.name: t for t in [
+    CsvTarget("devices", ["deviceId", "description"], [Device.id, Device.device_name], [Device.id], None),
+    CsvTarget("testers", ["testerId", "firstName", "lastName", "country", "lastLogin"],
+        [Tester.id, Tester.first_name, Tester.last_name, Tester.country, Tester.last_login], [Tester.id],
+        lambda r: (r[0], r[1], r[2], r[3], _login_time(r[4]))),
+    CsvTarget("tester_device", ["testerId", "deviceId"], [association_table.c.tester_id, association_table.c.device_id],
+        [association_table.c.tester_id, association_table.c.device_id], None),
+    CsvTarget("bugs", ["bugId", "deviceId", "testerId"], [Bug.id, Bug.device_id, Bug.tester_id], [Bug.id], None),
+    CsvTarget("experience", ["testerId", "deviceId", "bugs"], [Experience.tester_id, Experience.device_id, Experience.bugs],
+        [Experience.id], None),
+]}
+
+def table_rows(target, chunk_size=10000):
+    """
+    Stream a table's rows off one query, fetching chunk_size at a time
+
+    Args:
+      target:     The CsvTarget to read
+      chunk_size: Rows fetched from the database at a time
+    Yields:
+      Lists of rows in the target's column order
+    """
+    connection = db.session.connection()
+    query = select(target.columns).order_by(*target.order_by)
+    if connection.dialect.supports_server_side_cursors:
+        # Databases with server side cursors stream through them
+        result = connection.execute(query.execution_options(stream_results=True))
+        chunks = result.partitions(chunk_size)
+    else:
+        # SQLite's cursor already steps through the table as it is read, so
+        # rows come straight off the driver: building result rows costs
+        # several times more than reading them for plain dumps like these.
+        # Column types are then left to convert.
+        result = connection.connection.cursor()
+        result.execute(str(query.compile(dialect=connection.dialect)))
+        chunks = iter(lambda: result.fetchmany(chunk_size), [])
+    try:
+        for chunk in chunks:
+            yield chunk if target.convert is None else [target.convert(r) for r in chunk]
+    finally:
+        result.close()
+
+def search_headers(devices):
+    return ["rank", "testerId", "name", "totalBugs"] + ["device{}Bugs".format(d) for d in devices]
+
+def search_rows(country, devices, chunk_size=500):
+    """
+    Stream a whole search ranking with keyset paging, one row per tester with
+    their bugs on each of the devices
+
+    Args:
+      country:    The country code, or ALL for every country
+      devices:    Iterable of device ids in the search
+      chunk_size: Testers ranked and named at a time
+    Yields:
+      Lists of rows as tuples in search_headers order
+    """
+    devices = normalize_devices(devices)
+    rank = 0
+    for chunk in iter_rankings(country, devices, chunk_size=chunk_size):
+        rows = []
+        for r in result_rows(chunk):
+            rank += 1
+            bugs = {e.device_id: e.bugs for e in r.experiences}
+            rows.append((rank, r.tester_id, r.tester_name, r.total_bugs) + tuple(bugs.get(d, 0) for d in devices))
+        yield rows
+
+def encode(headers, chunks, fmt="csv"):
+    """
+    Turn chunks of rows into text, one piece per chunk so the first rows go
+    out before the rest are read. csv quotes every field like the shipped
+    files, ndjson writes one object per line keyed by the csv headers.
+
+    Args:
+      headers:  Column names
+      chunks:   Iterable of lists of row tuples
+      fmt:      csv or ndjson
+    Yields:
+      Strings
+    """
+    if fmt == "ndjson":
+        for chunk in chunks:
+            yield "".join(json.dumps(dict(zip(headers, row))) + "\n" for row in chunk)
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    writer.writerow(headers)
+    yield buffer.getvalue()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+def gzipped(pieces):
+    """
+    Gzip a stream of strings, flushing after each piece so a reader gets the
+    data as soon as it is encoded
+
+    Yields:
+      Bytes of one gzip stream
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for piece in pieces:
+        data = compressor.compress(piece.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
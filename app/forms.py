@@ -1,12 +1,11 @@
-from app import app, db
-from app.models import Bug, Device, Experience, Tester
+from app.catalog import device_catalog
 from flask_wtf import FlaskForm
 from wtforms import BooleanField, IntegerField, FloatField, SelectField, SelectMultipleField, StringField, SubmitField
 from wtforms.validators import DataRequired, Length, NumberRange, ValidationError
 
 def getDevices():
-    # Return device id/name pairings to populate the search form
-    return [(d.id, d.device_name) for d in db.session.query(Device).all()]
+    # Return device id/name pairings to populate the search form, from memory
+    return device_catalog.choices()
 
 class BugForm(FlaskForm):
     device_id = IntegerField("Device ID", validators=[DataRequired()])
@@ -44,5 +43,11 @@ class EditTesterForm(FlaskForm):
 
 class SearchForm(FlaskForm):
     country = StringField("Country code or ALL", validators=[DataRequired()])
-    device = SelectMultipleField("Device(s)", choices=getDevices(), validators=[DataRequired()])
-    submit = SubmitField("Submit")
\ No newline at end of file
+    device = SelectMultipleField("Device(s)", validators=[DataRequired()])
+    submit = SubmitField("Submit")
+
+    def __init__(self, *args, **kwargs):
+        # Fill in the devices per form, so new devices show up without a
+        # restart and importing the form does not touch the database
+        super(SearchForm, self).__init__(*args, **kwargs)
+        self.device.choices = getDevices()
\ No newline at end of file
@@ -0,0 +1,140 @@
+import threading
+
+from app import app
+from app.changes import data_changed
+from app.viewmodels import BugRow, DeviceRow, ExperienceRow, ResultRow, TesterRow
+from collections import OrderedDict
+from flask import request
+from jinja2 import pass_context
+from markupsafe import Markup
+
+# The partials only show the fields of the row they are given, and every row
+# carries the names it shows, so a row stands in for the version of what it
+# was built from: an entry rendered from an older row can never be served for
+# a newer one. Writes still drop the entries of the rows they touch, so
+# memory goes to rows that are current.
+
+def _tags(row):
+    # The (table, id) pairs a row was built from
+    if isinstance(row, TesterRow):
+        return {("tester", row.id)}
+    if isinstance(row, DeviceRow):
+        return {("device", row.id)}
+    if isinstance(row, BugRow):
+        return {("bug", row.id), ("tester", row.tester_id), ("device", row.device_id)}
+    if isinstance(row, ExperienceRow):
+        return {("tester", row.tester_id), ("device", row.device_id)}
+    if isinstance(row, ResultRow):
+        return {("tester", row.tester_id)} | {("device", e.device_id) for e in row.experiences}
+    return set()
+
+class FragmentCache(object):
+    """
+    Bounded cache of rendered partials, keyed by template and row, evicting
+    the least recently used fragment once full. Each entry is tagged with the
+    testers, bugs and devices its row was built from.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._tagged = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, html, tags):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._data[key] = (html, tags)
+            self._data.move_to_end(key)
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                old, (_, old_tags) = self._data.popitem(last=False)
+                self._untag(old, old_tags)
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+    def invalidate(self, tags):
+        """
+        Drop every fragment built from any of the (table, id) tags
+        """
+        with self._lock:
+            for tag in tags:
+                for key in self._tagged.pop(tag, ()):
+                    item = self._data.pop(key, None)
+                    if item is not None:
+                        self._untag(key, item[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tagged.clear()
+
+    def render(self, context, name, **values):
+        """
+        Render a partial with the template's context and values, or reuse the
+        HTML rendered for the same values before
+
+        Args:
+          context:  The calling template's context
+          name:     Template name of the partial, e.g. _tester.html
+          values:   Variables of the partial, usually a single row
+        Returns:
+          The HTML as Markup
+        """
+        # Links depend on where the app is mounted
+        key = (name, request.script_root) + tuple(sorted(values.items()))
+        html = self.get(key)
+        if html is None:
+            template = context.environment.get_template(name)
+            html = Markup(template.render(dict(context.get_all(), **values)))
+            tags = set()
+            for value in values.values():
+                tags |= _tags(value)
+            self.set(key, html, tags)
+        return html
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "size": len(self._data)}
+
+fragment_cache = FragmentCache(app.config["FRAGMENT_CACHE_SIZE"])
+
+@app.template_global("fragment")
+@pass_context
+def fragment(context, name, **values):
+    """
+    Use in templates instead of include, e.g.
+    {{ fragment('_tester.html', tester=tester) }}
+    """
+    return fragment_cache.render(context, name, **values)
+
+@data_changed.connect_via(app)
+def _invalidate(sender, changes):
+    tags = set()
+    for c in changes:
+        if c.table == "experience" and c.op == "rebuild":
+            fragment_cache.clear()
+            return
+        if c.table in ("tester", "bug", "device"):
+            tags.add((c.table, c.key))
+    if tags:
+        fragment_cache.invalidate(tags)
@@ -0,0 +1,100 @@
+import csv
+import itertools
+import os
+import time
+
+from app import db
+from app.experience import rebuild_experience
+from app.models import association_table, Bug, Device, Tester
+from collections import namedtuple
+from datetime import datetime
+
+# How a shipped csv file maps onto a table: the file name, the table to fill,
+# and a function turning one csv row into a dict of column values
+CsvSource = namedtuple("CsvSource", ["filename", "table", "convert"])
+
+# Outcome of importing one file, used for reporting
+ImportStats = namedtuple("ImportStats", ["filename", "rows", "seconds"])
+
+def _login_time(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+# Parents first so foreign keys always point at rows that already exist
+SOURCES = [
+    CsvSource("devices.csv", Device.__table__, lambda r: {"id": int(r["deviceId"]), "device_name": r["description"]}),
+    CsvSource("testers.csv", Tester.__table__, lambda r: {"id": int(r["testerId"]), "first_name": r["firstName"], "last_name": r["lastName"], "country": r["country"], "last_login": _login_time(r["lastLogin"])}),
+    CsvSource("tester_device.csv", association_table, lambda r: {"tester_id": int(r["testerId"]), "device_id": int(r["deviceId"])}),
+    CsvSource("bugs.csv", Bug.__table__, lambda r: {"id": int(r["bugId"]), "device_id": int(r["deviceId"]), "tester_id": int(r["testerId"])}),
+]
+
+def chunked(rows, size):
+    """
+    Split an iterable into lists of at most size items without ever holding
+    more than one list in memory
+
+    Args:
+      rows: Any iterable
+      size: Maximum length of each chunk
+    Yields:
+      Lists of consecutive items
+    """
+    it = iter(rows)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def import_file(path, source, chunk_size):
+    """
+    Stream one csv file into its table with chunked executemany inserts
+
+    Args:
+      path:       Location of the csv file
+      source:     The CsvSource describing the file
+      chunk_size: Number of rows sent to the database per insert
+    Returns:
+      ImportStats for the file
+    """
+    start = time.perf_counter()
+    rows = 0
+    with open(path, newline="") as f:
+        converted = (source.convert(r) for r in csv.DictReader(f))
+        for chunk in chunked(converted, chunk_size):
+            db.session.execute(source.table.insert(), chunk)
+            rows += len(chunk)
+    return ImportStats(source.filename, rows, time.perf_counter() - start)
+
+def import_csv(directory, chunk_size=10000, replace=False):
+    """
+    Load the shipped csv files from a directory in one transaction. Files that
+    are not there are skipped.
+
+    Args:
+      directory:  Folder holding testers.csv, devices.csv, tester_device.csv
+                  and bugs.csv
+      chunk_size: Number of rows sent to the database per insert
+      replace:    Empty the tables first, for full reloads
+    Returns:
+      List of ImportStats, one per imported file and one for Experience
+    """
+    stats = []
+    try:
+        # Children first when clearing, for the same foreign key reasons
+        if replace:
+            for source in reversed(SOURCES):
+                db.session.execute(source.table.delete())
+
+        for source in SOURCES:
+            path = os.path.join(directory, source.filename)
+            if os.path.exists(path):
+                stats.append(import_file(path, source, chunk_size))
+
+        start = time.perf_counter()
+        rows = rebuild_experience()
+        stats.append(ImportStats("experience", rows, time.perf_counter() - start))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return stats
@@ -0,0 +1,205 @@
+import bisect
+import heapq
+import threading
+import time
+
+from app import app
+from app.cache import search_cache
+from app.fragments import fragment_cache
+from flask import before_render_template, g, has_request_context, request, Response, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets, in seconds for timings and in
+# statements for the per request SQL count
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+# Statements kept per request for the slow request log, the slowest ones, so
+# a request running thousands of them does not hold on to all their text
+MAX_LOGGED_STATEMENTS = 50
+
+class Histogram(object):
+    """
+    Prometheus style histogram: a count per bucket, plus the sum and count of
+    every observed value
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        # Buckets are cumulative in the text format, the last one is +Inf
+        out = []
+        total = 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += n
+            out.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, total))
+        out.append("{}_sum{{{}}} {}".format(name, labels, self.sum))
+        out.append("{}_count{{{}}} {}".format(name, labels, self.count))
+        return out
+
+class RequestStats(object):
+    """
+    What one request spent its time on, kept on flask.g while it runs
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = []
+        self.template_seconds = 0.0
+        self.template_start = None
+        self.status = 500
+
+class Metrics(object):
+    """
+    Per endpoint histograms of request, view, template and SQL time, and of
+    statements per request, for this process
+    """
+    HISTOGRAMS = (
+        ("testmatch_request_seconds", TIME_BUCKETS, "Time from the start of a request to its teardown."),
+        ("testmatch_view_seconds", TIME_BUCKETS, "Request time spent outside template rendering, SQL included."),
+        ("testmatch_template_seconds", TIME_BUCKETS, "Time spent rendering templates, queries they run included."),
+        ("testmatch_sql_seconds", TIME_BUCKETS, "Time spent executing SQL statements."),
+        ("testmatch_sql_statements", COUNT_BUCKETS, "SQL statements executed per request."),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = {}
+
+    def record(self, endpoint, stats, seconds):
+        values = (seconds, seconds - stats.template_seconds, stats.template_seconds, stats.sql_seconds, stats.sql_count)
+        with self._lock:
+            for (name, buckets, _), value in zip(self.HISTOGRAMS, values):
+                key = (name, endpoint)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(buckets)
+                self._histograms[key].observe(value)
+            key = (endpoint, stats.status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    def lines(self):
+        with self._lock:
+            out = ["# HELP testmatch_requests_total Requests served.", "# TYPE testmatch_requests_total counter"]
+            for (endpoint, status), n in sorted(self._requests.items()):
+                out.append('testmatch_requests_total{{endpoint="{}",status="{}"}} {}'.format(endpoint, status, n))
+            for name, _, text in self.HISTOGRAMS:
+                out.append("# HELP {} {}".format(name, text))
+                out.append("# TYPE {} histogram".format(name))
+                for (key_name, endpoint), histogram in sorted(self._histograms.items()):
+                    if key_name == name:
+                        out.extend(histogram.lines(name, 'endpoint="{}"'.format(endpoint)))
+            return out
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._requests.clear()
+
+metrics = Metrics()
+
+def _stats():
+    # The running request's stats, None outside requests (e.g. cli commands)
+    if has_request_context():
+        return g.get("request_stats")
+    return None
+
+# Listening on the Engine class covers every engine, whichever one a session
+# is bound to
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _stats()
+    if stats is not None:
+        stats.sql_count += 1
+        stats.sql_seconds += seconds
+        # A min-heap on time, the fastest kept statement is the one dropped
+        if len(stats.statements) < MAX_LOGGED_STATEMENTS:
+            heapq.heappush(stats.statements, (seconds, statement))
+        else:
+            heapq.heappushpop(stats.statements, (seconds, statement))
+
+@before_render_template.connect_via(app)
+def _before_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.template_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _after_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.template_start is not None:
+        stats.template_seconds += time.perf_counter() - stats.template_start
+        stats.template_start = None
+
+@app.before_request
+def _start_request():
+    if app.config["METRICS_ENABLED"]:
+        g.request_stats = RequestStats()
+
+@app.after_request
+def _finish_response(response):
+    stats = _stats()
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+@app.teardown_request
+def _end_request(error):
+    stats = _stats()
+    if stats is None:
+        return
+    g.pop("request_stats")
+    seconds = time.perf_counter() - stats.start
+    endpoint = request.endpoint or "unmatched"
+    metrics.record(endpoint, stats, seconds)
+
+    if seconds * 1000 >= app.config["SLOW_REQUEST_MS"]:
+        app.logger.warning("Slow request %s %s: %.1f ms, %.1f ms rendering, %d statements in %.1f ms\n%s",
+            request.method, request.full_path.rstrip("?"), seconds * 1000, stats.template_seconds * 1000,
+            stats.sql_count, stats.sql_seconds * 1000,
+            "\n".join("  {:8.1f} ms  {}".format(s * 1000, " ".join(sql.split())) for s, sql in sorted(stats.statements, reverse=True)))
+
+@app.route("/metrics")
+def metrics_text():
+    """
+    This process's request metrics and search and fragment cache counters in
+    the Prometheus text format
+    """
+    cache = search_cache.stats()
+    fragments = fragment_cache.stats()
+    lines = metrics.lines() + [
+        "# HELP testmatch_search_cache_hits_total Searches answered from the cache.",
+        "# TYPE testmatch_search_cache_hits_total counter",
+        "testmatch_search_cache_hits_total {}".format(cache["hits"]),
+        "# HELP testmatch_search_cache_misses_total Searches that had to be ranked.",
+        "# TYPE testmatch_search_cache_misses_total counter",
+        "testmatch_search_cache_misses_total {}".format(cache["misses"]),
+        "# HELP testmatch_search_cache_entries Searches held in the cache.",
+        "# TYPE testmatch_search_cache_entries gauge",
+        "testmatch_search_cache_entries {}".format(cache["size"]),
+        "# HELP testmatch_fragment_cache_hits_total Partials served from the fragment cache.",
+        "# TYPE testmatch_fragment_cache_hits_total counter",
+        "testmatch_fragment_cache_hits_total {}".format(fragments["hits"]),
+        "# HELP testmatch_fragment_cache_misses_total Partials that had to be rendered.",
+        "# TYPE testmatch_fragment_cache_misses_total counter",
+        "testmatch_fragment_cache_misses_total {}".format(fragments["misses"]),
+        "# HELP testmatch_fragment_cache_entries Partials held in the fragment cache.",
+        "# TYPE testmatch_fragment_cache_entries gauge",
+        "testmatch_fragment_cache_entries {}".format(fragments["size"]),
+    ]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,228 @@
+from app import app, db
+from app.changes import changes_recorded
+from app.models import Experience, Leaderboard, LeaderboardFloor, Tester
+from sqlalchemy import and_, func, literal, select
+
+# Largest IN list sent in one statement
+LOOKUP_CHUNK = 500
+
+# The leaderboard rollup keeps, for every (country, device) and (ALL, device),
+# up to LEADERBOARD_SIZE testers with the most bugs on that device, plus a
+# floor: no tester left off that board has more bugs than it. Rows are
+# changed in the transaction of every Experience change, so the rollup is
+# always exact for the testers it holds. A search is answered from it when
+# enough of its testers beat the sum of the floors to fill the page.
+
+def _ranked(per_country):
+    # Every positive experience row numbered by its place on its board
+    e, t = Experience.__table__, Tester.__table__
+    if per_country:
+        country = t.c.country
+        source = e.join(t, t.c.id == e.c.tester_id)
+        partition = [t.c.country, e.c.device_id]
+    else:
+        country = literal("ALL")
+        source = e
+        partition = [e.c.device_id]
+    place = func.row_number().over(partition_by=partition, order_by=[e.c.bugs.desc(), e.c.tester_id])
+    q = select([country.label("country"), e.c.device_id, e.c.tester_id, e.c.bugs, place.label("place")]) \
+        .select_from(source).where(and_(e.c.bugs > 0, e.c.tester_id.isnot(None), e.c.device_id.isnot(None)))
+    if per_country:
+        q = q.where(t.c.country.isnot(None))
+    return q.subquery()
+
+def rebuild_leaderboards(connection=None):
+    """
+    Recompute every board from Experience with one windowed query per kind
+    of board. Runs in the current transaction, the caller commits.
+
+    Args:
+      connection: Connection of the transaction, db.session's by default
+    Returns:
+      Number of leaderboard rows written
+    """
+    connection = connection or db.session.connection()
+    size = app.config["LEADERBOARD_SIZE"]
+    boards, floors = Leaderboard.__table__, LeaderboardFloor.__table__
+    connection.execute(boards.delete())
+    connection.execute(floors.delete())
+    rows = 0
+    for per_country in (False, True):
+        ranked = _ranked(per_country)
+        result = connection.execute(boards.insert().from_select(["country", "device_id", "tester_id", "bugs"],
+            select([ranked.c.country, ranked.c.device_id, ranked.c.tester_id, ranked.c.bugs]).where(ranked.c.place <= size)))
+        rows += result.rowcount
+        # The first tester left off a board sets its floor
+        connection.execute(floors.insert().from_select(["country", "device_id", "bugs"],
+            select([ranked.c.country, ranked.c.device_id, ranked.c.bugs]).where(ranked.c.place == size + 1)))
+    return rows
+
+def _board_state(connection, countries, device_ids, tester_ids):
+    # Which of the testers are on which of the boards, and the boards' floors
+    boards, floors = Leaderboard.__table__, LeaderboardFloor.__table__
+    members = {tuple(r) for r in connection.execute(select([boards.c.country, boards.c.device_id, boards.c.tester_id])
+        .where(and_(boards.c.country.in_(countries), boards.c.device_id.in_(device_ids), boards.c.tester_id.in_(tester_ids))))}
+    floor_of = {(r[0], r[1]): r[2] for r in connection.execute(select([floors.c.country, floors.c.device_id, floors.c.bugs])
+        .where(and_(floors.c.country.in_(countries), floors.c.device_id.in_(device_ids))))}
+    return members, floor_of
+
+def _place(connection, country, device_id, tester_id, bugs, members, floor_of):
+    # Put a tester's new bug count on one board, keeping the floor true
+    boards, floors = Leaderboard.__table__, LeaderboardFloor.__table__
+    board = and_(boards.c.country == country, boards.c.device_id == device_id)
+    row = and_(board, boards.c.tester_id == tester_id)
+    if (country, device_id, tester_id) in members:
+        if bugs > 0:
+            connection.execute(boards.update().where(row).values(bugs=bugs))
+        else:
+            connection.execute(boards.delete().where(row))
+            members.discard((country, device_id, tester_id))
+        return
+
+    # Off the board testers stay off unless they beat the floor
+    floor = floor_of.get((country, device_id), 0)
+    if bugs <= floor:
+        return
+    connection.execute(boards.insert().values(country=country, device_id=device_id, tester_id=tester_id, bugs=bugs))
+    members.add((country, device_id, tester_id))
+
+    # Past the board size the lowest testers leave, raising the floor to
+    # their count
+    extra = connection.execute(select([boards.c.tester_id, boards.c.bugs]).where(board)
+        .order_by(boards.c.bugs.desc(), boards.c.tester_id).offset(app.config["LEADERBOARD_SIZE"])).fetchall()
+    if not extra:
+        return
+    connection.execute(boards.delete().where(and_(board, boards.c.tester_id.in_([t for t, _ in extra]))))
+    members.difference_update((country, device_id, t) for t, _ in extra)
+    floor_of[(country, device_id)] = max([floor] + [b for _, b in extra])
+    where = and_(floors.c.country == country, floors.c.device_id == device_id)
+    if not connection.execute(floors.update().where(where).values(bugs=floor_of[(country, device_id)])).rowcount:
+        connection.execute(floors.insert().values(country=country, device_id=device_id, bugs=floor_of[(country, device_id)]))
+
+def update_leaderboards(connection, pairs):
+    """
+    Move the testers of changed Experience rows on their boards
+
+    Args:
+      connection: The connection of the transaction that changed Experience
+      pairs:      Iterable of (tester_id, device_id) whose counts changed
+    """
+    pairs = {(t, d) for t, d in pairs if t is not None and d is not None}
+    if not pairs or not app.config["LEADERBOARD_SIZE"]:
+        return
+    e, t = Experience.__table__, Tester.__table__
+    testers = {p[0] for p in pairs}
+    devices = {p[1] for p in pairs}
+
+    # New counts and countries in one query, then the boards they touch
+    counts, countries = {}, {}
+    for tester_id, device_id, bugs, country in connection.execute(
+            select([e.c.tester_id, e.c.device_id, e.c.bugs, t.c.country])
+            .select_from(e.outerjoin(t, t.c.id == e.c.tester_id))
+            .where(and_(e.c.tester_id.in_(testers), e.c.device_id.in_(devices)))):
+        counts[(tester_id, device_id)] = bugs or 0
+        countries[tester_id] = country
+    if len(countries) < len(testers):
+        countries.update((r[0], r[1]) for r in connection.execute(select([t.c.id, t.c.country])
+            .where(t.c.id.in_(testers - set(countries)))))
+    members, floor_of = _board_state(connection, {"ALL"} | set(countries.values()), devices, testers)
+
+    for tester_id, device_id in sorted(pairs):
+        bugs = counts.get((tester_id, device_id), 0)
+        _place(connection, "ALL", device_id, tester_id, bugs, members, floor_of)
+        if countries.get(tester_id) is not None:
+            _place(connection, countries[tester_id], device_id, tester_id, bugs, members, floor_of)
+
+def _move_tester(connection, tester_id, old_country, new_country):
+    # Take a tester off their old country's boards and offer their counts
+    # to the new one's
+    boards, e = Leaderboard.__table__, Experience.__table__
+    if old_country is not None:
+        connection.execute(boards.delete().where(and_(boards.c.tester_id == tester_id, boards.c.country == old_country)))
+    if new_country is None:
+        return
+    rows = connection.execute(select([e.c.device_id, e.c.bugs])
+        .where(and_(e.c.tester_id == tester_id, e.c.bugs > 0, e.c.device_id.isnot(None)))).fetchall()
+    if rows:
+        members, floor_of = _board_state(connection, [new_country], [d for d, _ in rows], [tester_id])
+        for device_id, bugs in rows:
+            _place(connection, new_country, device_id, tester_id, bugs, members, floor_of)
+
+@changes_recorded.connect
+def _follow(session, changes):
+    if not app.config["LEADERBOARD_SIZE"]:
+        return
+    connection = session.connection()
+    for c in changes:
+        if c.table == "experience" and c.op == "rebuild":
+            rebuild_leaderboards(connection)
+            return
+    boards, floors = Leaderboard.__table__, LeaderboardFloor.__table__
+    testers, devices = [], []
+    for c in changes:
+        if c.table == "device" and c.op == "delete":
+            devices.append(c.key)
+        if c.table != "tester":
+            continue
+        if c.op == "delete":
+            testers.append(c.key)
+        elif c.op == "insert" or c.old["country"] != c.new["country"]:
+            _move_tester(connection, c.key, c.old and c.old["country"], c.new["country"])
+
+    # Their experience rows no longer count towards any search, and deleted
+    # devices take their boards with them
+    for i in range(0, len(testers), LOOKUP_CHUNK):
+        connection.execute(boards.delete().where(boards.c.tester_id.in_(testers[i:i + LOOKUP_CHUNK])))
+    for i in range(0, len(devices), LOOKUP_CHUNK):
+        chunk = devices[i:i + LOOKUP_CHUNK]
+        connection.execute(boards.delete().where(boards.c.device_id.in_(chunk)))
+        connection.execute(floors.delete().where(floors.c.device_id.in_(chunk)))
+
+def top_testers(country, device_ids, limit=None, offset=0, after=None):
+    """
+    Rank a search from the leaderboards when they hold enough testers
+
+    Args:
+      country:    The country code, or ALL for every country
+      device_ids: Sorted list of integer device ids in the search
+      limit:      Maximum number of testers to return, None for all of them
+      offset:     Number of top testers to skip
+      after:      Optional (total_bugs, tester_id) keyset cursor
+    Returns:
+      List of (tester_id, total_bugs) like ranking_query's rows, or None when
+      the search needs the full ranking
+    """
+    if not app.config["LEADERBOARD_SIZE"] or not device_ids or len(device_ids) > app.config["LEADERBOARD_MAX_DEVICES"]:
+        return None
+    boards, floors = Leaderboard.__table__, LeaderboardFloor.__table__
+    rows = db.session.execute(select([boards.c.tester_id, boards.c.bugs])
+        .where(and_(boards.c.country == country, boards.c.device_id.in_(device_ids)))).fetchall()
+
+    # Testers on none of the boards have at most the sum of the floors
+    bound = db.session.execute(select([func.coalesce(func.sum(floors.c.bugs), 0)])
+        .where(and_(floors.c.country == country, floors.c.device_id.in_(device_ids)))).scalar()
+
+    # Board counts are exact, but testers on only some of the boards need
+    # their counts on the other devices from Experience
+    if len(device_ids) == 1:
+        totals = dict(rows)
+    else:
+        e = Experience.__table__
+        candidates = sorted({r[0] for r in rows})
+        totals = {}
+        if candidates:
+            totals = {r[0]: r[1] for r in db.session.execute(select([e.c.tester_id, func.sum(e.c.bugs)])
+                .where(and_(e.c.tester_id.in_(candidates), e.c.device_id.in_(device_ids))).group_by(e.c.tester_id))}
+
+    ranked = sorted(((t, int(b)) for t, b in totals.items() if b and b > 0), key=lambda r: (-r[1], r[0]))
+    if after is not None:
+        ranked = [r for r in ranked if r[1] < after[0] or (r[1] == after[0] and r[0] > after[1])]
+
+    # Only testers above the bound are known to be in their final order,
+    # unless the bound is 0 and every tester with bugs is on a board
+    if bound:
+        wanted = None if limit is None else offset + limit
+        certain = sum(1 for r in ranked if r[1] > bound)
+        if wanted is None or wanted > certain:
+            return None
+    return ranked[offset:] if limit is None else ranked[offset:offset + limit]
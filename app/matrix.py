@@ -0,0 +1,237 @@
+import threading
+import time
+
+from app import app, db
+from app.changes import data_changed
+from app.models import Experience, Tester
+from app.ranking import DeviceBugs, normalize_devices, TesterRank
+from app.versions import GenerationWatch
+
+# numpy is optional, without it searches always go to SQL
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def _capacity(n):
+    # Rows or columns allocated for n, leaving room to grow
+    return n + n // 8 + 16
+
+class MatchIndex(object):
+    """
+    In memory copy of Experience as a dense tester x device matrix of bug
+    counts, plus the matrix rows of the testers in each country. A search is
+    then a sum over a few columns and a partial sort, with no SQL at all.
+
+    The index is built on first use and follows bug and tester writes
+    committed by this process. It is rebuilt once the generation counters
+    show writes from other processes, and once older than max_age seconds.
+    Rankings match app.ranking.rank_testers.
+
+    The matrix holds int32 counts and is allocated with room to spare: new
+    testers and devices take free rows and columns, and only filling it
+    copies it, into one an eighth larger.
+    """
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._built = None
+        self._matrix = None
+        self._tester_ids = None
+        self._rows = 0
+        self._cols = 0
+        self._row_of = {}
+        self._col_of = {}
+        self._country_rows = {}
+        self._country_of = {}
+        self._watch = GenerationWatch("bug", "tester", "experience", "device-deletes")
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def build(self, values=None):
+        """
+        Load the whole Experience table and every tester's country
+
+        Args:
+          values: The watched generation counters, read before calling
+        """
+        with self._lock:
+            if values is None:
+                values = self._watch.read()
+            testers = db.session.query(Tester.id, Tester.country).order_by(Tester.id).all()
+            exps = db.session.query(Experience.tester_id, Experience.device_id, Experience.bugs) \
+                .filter(Experience.tester_id.isnot(None), Experience.device_id.isnot(None)).all()
+
+            # Experience rows may point at testers that no longer exist, they
+            # still count towards ALL searches like they do in SQL
+            tester_ids = sorted({t for t, _ in testers} | {e[0] for e in exps})
+            device_ids = sorted({e[1] for e in exps})
+            self._row_of = {t: i for i, t in enumerate(tester_ids)}
+            self._col_of = {d: i for i, d in enumerate(device_ids)}
+            self._rows, self._cols = len(tester_ids), len(device_ids)
+            self._tester_ids = np.zeros(_capacity(self._rows), dtype=np.int64)
+            self._tester_ids[:self._rows] = tester_ids
+            self._matrix = np.zeros((_capacity(self._rows), _capacity(self._cols)), dtype=np.int32)
+            if exps:
+                rows = np.array([self._row_of[e[0]] for e in exps], dtype=np.int64)
+                cols = np.array([self._col_of[e[1]] for e in exps], dtype=np.int64)
+                np.add.at(self._matrix, (rows, cols), np.array([e[2] or 0 for e in exps], dtype=np.int32))
+
+            self._country_of = dict(testers)
+            self._country_rows = {}
+            for tester_id, country in testers:
+                self._country_rows.setdefault(country, set()).add(self._row_of[tester_id])
+            self._built = time.monotonic()
+
+            # A write committed while loading may or may not have been read,
+            # following it could count it twice, so build again instead
+            self._watch.loaded(values if self._watch.read() == values else None)
+
+    def _ensure_built(self):
+        values = self._watch.read()
+        if self._built is None or values != self._watch.seen or time.monotonic() - self._built > self.max_age:
+            self.build(values)
+
+    def follow(self):
+        """
+        Returns:
+          False when the index missed writes of other processes, and has to
+          be rebuilt rather than follow this process's commit
+        """
+        with self._lock:
+            return self._built is not None and self._watch.follow()
+
+    def _reserve(self, rows, cols):
+        # Copy the matrix into a larger one once it has no room left
+        if rows <= self._matrix.shape[0] and cols <= self._matrix.shape[1]:
+            return
+        shape = (self._matrix.shape[0] if rows <= self._matrix.shape[0] else _capacity(rows),
+            self._matrix.shape[1] if cols <= self._matrix.shape[1] else _capacity(cols))
+        matrix = np.zeros(shape, dtype=np.int32)
+        matrix[:self._rows, :self._cols] = self._matrix[:self._rows, :self._cols]
+        self._matrix = matrix
+        if shape[0] > len(self._tester_ids):
+            tester_ids = np.zeros(shape[0], dtype=np.int64)
+            tester_ids[:self._rows] = self._tester_ids[:self._rows]
+            self._tester_ids = tester_ids
+
+    def _row(self, tester_id):
+        # Take the next free row for a tester the matrix has not seen yet
+        row = self._row_of.get(tester_id)
+        if row is None:
+            self._reserve(self._rows + 1, self._cols)
+            row = self._rows
+            self._rows += 1
+            self._row_of[tester_id] = row
+            self._tester_ids[row] = tester_id
+        return row
+
+    def _col(self, device_id):
+        col = self._col_of.get(device_id)
+        if col is None:
+            self._reserve(self._rows, self._cols + 1)
+            col = self._cols
+            self._cols += 1
+            self._col_of[device_id] = col
+        return col
+
+    def add_bugs(self, tester_id, device_id, delta):
+        with self._lock:
+            if self._built is not None:
+                # Both may grow the matrix, so look them up before indexing it
+                row, col = self._row(tester_id), self._col(device_id)
+                self._matrix[row, col] += delta
+
+    def set_country(self, tester_id, country):
+        # None removes the tester from every country, for deleted testers
+        with self._lock:
+            if self._built is None:
+                return
+            row = self._row(tester_id)
+            old = self._country_of.pop(tester_id, None)
+            if old in self._country_rows:
+                self._country_rows[old].discard(row)
+            if country is not None:
+                self._country_of[tester_id] = country
+                self._country_rows.setdefault(country, set()).add(row)
+
+    def invalidate(self):
+        with self._lock:
+            self._built = None
+
+    def rank_testers(self, country, devices, limit=None, offset=0, after=None):
+        """
+        Same arguments and result as app.ranking.rank_testers
+        """
+        with self._lock:
+            self._ensure_built()
+            device_ids = [d for d in normalize_devices(devices) if d in self._col_of]
+            cols = [self._col_of[d] for d in device_ids]
+            if not cols:
+                return []
+            if country == "ALL":
+                rows = np.arange(self._rows)
+            else:
+                rows = np.fromiter(sorted(self._country_rows.get(country, ())), dtype=np.int64)
+            counts = self._matrix[np.ix_(rows, cols)]
+            tester_ids = self._tester_ids[rows]
+
+        totals = counts.sum(axis=1)
+        keep = totals > 0
+        if after is not None:
+            keep &= (totals < after[0]) | ((totals == after[0]) & (tester_ids > after[1]))
+        candidates = np.flatnonzero(keep)
+
+        # Only the top offset + limit need sorting, everything tied with the
+        # last of them is kept so ties still break on tester id
+        if limit is not None and offset + limit < len(candidates):
+            k = offset + limit
+            threshold = -np.partition(-totals[candidates], k - 1)[k - 1]
+            candidates = candidates[totals[candidates] >= threshold]
+        order = candidates[np.lexsort((tester_ids[candidates], -totals[candidates]))]
+        order = order[offset:] if limit is None else order[offset:offset + limit]
+
+        # Breakdown in device id order, leaving out devices without bugs
+        return [TesterRank(int(tester_ids[i]), int(totals[i]),
+            [DeviceBugs(d, int(b)) for d, b in zip(device_ids, counts[i]) if b > 0]) for i in order]
+
+match_index = MatchIndex(app.config["MATCH_INDEX_MAX_AGE"])
+
+def use_match_index(engine=None):
+    """
+    Whether a search should be answered by the in memory index
+
+    Args:
+      engine: "matrix" or "sql" asked for by the request, None for the
+              MATCH_ENGINE default
+    Returns:
+      True when the index is asked for and numpy is installed
+    """
+    return (engine or app.config["MATCH_ENGINE"]) == "matrix" and match_index.available()
+
+@data_changed.connect_via(app)
+def _follow(sender, changes):
+    if not match_index.available():
+        return
+    if not match_index.follow():
+        match_index.invalidate()
+        return
+    for c in changes:
+        if c.table == "experience" and c.op == "rebuild":
+            match_index.invalidate()
+            return
+        if c.table == "bug":
+            # Edits show up as both, moving the bug from one pair to another
+            if c.old:
+                match_index.add_bugs(c.old["tester_id"], c.old["device_id"], -1)
+            if c.new:
+                match_index.add_bugs(c.new["tester_id"], c.new["device_id"], 1)
+        elif c.op == "delete" and c.table in ("tester", "device"):
+            # Deleting a tester or device also deletes their bugs and
+            # experience rows, which the change does not itemize
+            match_index.invalidate()
+            return
+        elif c.table == "tester":
+            match_index.set_country(c.key, c.new["country"])
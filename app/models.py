@@ -1,15 +1,31 @@
 from app import db
+from datetime import datetime
+
+def versioned():
+    """
+    Columns marking when a row last changed: a counter bumped by every UPDATE,
+    ORM or core, and the time of that update. Pages use them as cache
+    validators.
+    """
+    return (
+        db.Column(db.Integer, nullable=False, default=1, server_default="1", onupdate=db.literal_column("version + 1")),
+        db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow),
+    )
 
 association_table = db.Table('association', db.Model.metadata,
-    db.Column('tester_id', db.Integer, db.ForeignKey('tester.id')),
-    db.Column('device_id', db.Integer, db.ForeignKey('device.id'))
+    db.Column('tester_id', db.Integer, db.ForeignKey('tester.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('device_id', db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), primary_key=True, index=True)
 )
 
 class Bug(db.Model):
     # __tablename__ = 'bug'
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.Integer, db.ForeignKey('device.id'))
-    tester_id = db.Column(db.Integer, db.ForeignKey('tester.id'))
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'), index=True)
+    tester_id = db.Column(db.Integer, db.ForeignKey('tester.id', ondelete='CASCADE'))
+    version, updated_at = versioned()
+
+    # Serves per tester lookups and the GROUP BY that rebuilds Experience
+    __table_args__ = (db.Index('ix_bug_tester_device', 'tester_id', 'device_id'),)
 
     def __repr__(self):
         return '<Bug {} found on {} by {}>'.format(self.id, self.device_id, self.tester_id)
@@ -18,7 +34,8 @@ class Device(db.Model):
     __tablename__ = 'device'
     id = db.Column(db.Integer, primary_key=True)
     device_name = db.Column(db.String(64), index=True, unique=True)
-    testers = db.relationship("Tester", secondary=association_table, back_populates="devices")
+    testers = db.relationship("Tester", secondary=association_table, back_populates="devices", passive_deletes=True)
+    version, updated_at = versioned()
 
     def __repr__(self):
         return '<{}>'.format(self.device_name)
@@ -26,9 +43,16 @@ class Device(db.Model):
 class Experience(db.Model):
     # __tablename__ = 'experience'
     id = db.Column(db.Integer, primary_key=True)
-    device_id = db.Column(db.Integer, db.ForeignKey('device.id'))
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id', ondelete='CASCADE'))
     bugs = db.Column(db.Integer)
-    tester_id = db.Column(db.Integer, db.ForeignKey('tester.id'))
+    tester_id = db.Column(db.Integer, db.ForeignKey('tester.id', ondelete='CASCADE'))
+
+    # Covers the search query so it never has to touch the table itself, and
+    # keeps a single counter per tester/device pair
+    __table_args__ = (
+        db.Index('ix_experience_device_tester_bugs', 'device_id', 'tester_id', 'bugs'),
+        db.UniqueConstraint('tester_id', 'device_id', name='uq_experience_tester_device'),
+    )
 
     def __repr__(self):
         return '<Tester {} has filed {} bugs on {}>'.format(self.tester_id, self.bugs, self.device_id)
@@ -40,11 +64,69 @@ class Tester(db.Model):
     last_name = db.Column(db.String(64), index=True)
     country = db.Column(db.String(2), index=True)
     last_login = db.Column(db.DateTime, index=True)
-    experience = db.relationship("Experience", backref="tester")
-    devices = db.relationship("Device", secondary=association_table, back_populates="testers")
+    # Child rows go with the tester through ON DELETE CASCADE rather than
+    # being loaded to be deleted, see app.purge
+    experience = db.relationship("Experience", backref="tester", cascade="all", passive_deletes=True)
+    devices = db.relationship("Device", secondary=association_table, back_populates="testers", passive_deletes=True)
+    version, updated_at = versioned()
+
+    # Country filtered searches join on tester id within a country
+    __table_args__ = (db.Index('ix_tester_country_id', 'country', 'id'),)
 
     def __repr__(self):
         return '<Tester {} {} from {} last seen {}>'.format(self.first_name, self.last_name, self.country, self.last_login)
     
     def name(self):
         return self.first_name + " " + self.last_name + " (" + self.country + ")"
+
+class Generation(db.Model):
+    # One counter per table ("bug", "tester", "device", "association",
+    # "experience") plus "all", bumped in the transaction of every write, and
+    # "bug-deletes", "tester-deletes" and "device-deletes", see app.versions
+    __tablename__ = 'generation'
+    name = db.Column(db.String(16), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<Generation {} of {}>'.format(self.value, self.name)
+
+class Leaderboard(db.Model):
+    # Top testers per device in a country, or in ALL of them, see
+    # app.leaderboard
+    __tablename__ = 'leaderboard'
+    country = db.Column(db.String(3), primary_key=True)
+    device_id = db.Column(db.Integer, primary_key=True)
+    tester_id = db.Column(db.Integer, primary_key=True, index=True)
+    bugs = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<Leaderboard {} {}: tester {} with {} bugs>'.format(self.country, self.device_id, self.tester_id, self.bugs)
+
+class LeaderboardFloor(db.Model):
+    # Most bugs of any tester left off a board, 0 when there is no row
+    __tablename__ = 'leaderboard_floor'
+    country = db.Column(db.String(3), primary_key=True)
+    device_id = db.Column(db.Integer, primary_key=True)
+    bugs = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<LeaderboardFloor {} {}: {}>'.format(self.country, self.device_id, self.bugs)
+
+class ChangeLog(db.Model):
+    # Every recorded change, appended in the transaction that made it, see
+    # app.changelog. key, old and new hold JSON
+    __tablename__ = 'change_log'
+    seq = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(16), nullable=False)
+    op = db.Column(db.String(8), nullable=False)
+    key = db.Column(db.String(32))
+    old = db.Column(db.Text)
+    new = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    # Sequence numbers are never reused, even after the log is trimmed
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return '<ChangeLog {} {} {} {}>'.format(self.seq, self.op, self.table_name, self.key)
@@ -0,0 +1,63 @@
+import threading
+import time
+
+from app import app, db
+from app.cache import search_cache
+from app.matrix import match_index, use_match_index
+from app.ranking import rank_testers
+from app.viewmodels import result_rows
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import g
+
+# One search of a multi search, with its device ids normalized, and what it
+# gave: the ResultRows of its page and the milliseconds it took
+Search = namedtuple("Search", ["country", "devices", "limit", "after"])
+SearchResult = namedtuple("SearchResult", ["search", "rows", "elapsed_ms"])
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+    """
+    The worker threads shared by every multi search, started on first use
+    with MULTI_SEARCH_WORKERS threads
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=app.config["MULTI_SEARCH_WORKERS"], thread_name_prefix="search")
+        return _pool
+
+def _run(search, engine):
+    # Each worker thread gets its own app context and so its own session,
+    # removed again when the context is popped
+    with app.app_context():
+        g.read_only = True
+        start = time.perf_counter()
+        country, devices, limit, after = search
+        if use_match_index(engine):
+            ranking = match_index.rank_testers(country, devices, limit=limit, after=after)
+        elif after is None:
+            ranking = search_cache.rank_testers(country, devices, limit=limit)
+        else:
+            ranking = rank_testers(country, devices, limit=limit, after=after)
+        rows = result_rows(ranking)
+        db.session.rollback()
+        return SearchResult(search, rows, (time.perf_counter() - start) * 1000)
+
+def run_searches(searches, engine=None):
+    """
+    Run many searches at once on the worker pool. Identical searches are
+    only run once, and each distinct one runs in its own thread with its own
+    database session, so the whole takes about as long as the slowest.
+
+    Args:
+      searches: List of Search tuples
+      engine:   sql or matrix, None for the MATCH_ENGINE default
+    Returns:
+      Dict of each distinct Search to its SearchResult
+    """
+    distinct = list(dict.fromkeys(searches))
+    futures = {s: pool().submit(_run, s, engine) for s in distinct}
+    return {s: f.result() for s, f in futures.items()}
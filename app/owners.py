@@ -0,0 +1,250 @@
+import heapq
+import threading
+import time
+
+from app import app, db
+from app.changes import data_changed
+from app.importer import chunked
+from app.models import association_table, Experience, Tester
+from app.ranking import normalize_devices, ranking_query, TesterRank, with_breakdown
+from app.versions import GenerationWatch
+from sqlalchemy import and_, func, select
+
+# Owners looked up per IN query
+LOOKUP_CHUNK = 500
+
+# Matching modes: testers owning every device of the search, or any of them
+MATCH_MODES = ("all", "any")
+
+def _bitmap(ids):
+    # Python int with the bit of every id set, built through a byte array
+    # since or-ing one bit at a time copies the whole int every time
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
+
+def _bytes(bitmap):
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+
+def _has(bits, i):
+    # Membership in a bitmap turned into bytes, without shifting the int
+    return (i >> 3) < len(bits) and bits[i >> 3] >> (i & 7) & 1
+
+def _ids(bits):
+    # The set ids of a bitmap turned into bytes, in ascending order
+    for index, byte in enumerate(bits):
+        while byte:
+            low = byte & -byte
+            yield index * 8 + low.bit_length() - 1
+            byte ^= low
+
+class OwnerIndex(object):
+    """
+    Tester id bitsets per device, built from association_table, and per
+    country, built from Tester.country. Which testers own all or any of a
+    search's devices in a country is then a few ands and ors of ints.
+
+    Like the match index, it is built on first use and follows the tester
+    and device list changes committed by this process. It is rebuilt once
+    the generation counters show writes from other processes, and once older
+    than max_age seconds.
+    """
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._built = None
+        self._devices = {}
+        self._countries = {}
+        self._country_of = {}
+        self._watch = GenerationWatch("tester", "association", "experience", "device-deletes")
+
+    def build(self, values=None):
+        with self._lock:
+            if values is None:
+                values = self._watch.read()
+            owned = {}
+            for tester_id, device_id in db.session.execute(association_table.select()):
+                owned.setdefault(device_id, []).append(tester_id)
+            testers = db.session.query(Tester.id, Tester.country).all()
+            in_country = {}
+            for tester_id, country in testers:
+                in_country.setdefault(country, []).append(tester_id)
+            self._devices = {d: _bitmap(ids) for d, ids in owned.items()}
+            self._countries = {c: _bitmap(ids) for c, ids in in_country.items()}
+            self._country_of = dict(testers)
+            self._built = time.monotonic()
+
+            # Same as MatchIndex.build, a write committed while loading is
+            # not followed
+            self._watch.loaded(values if self._watch.read() == values else None)
+
+    def _ensure_built(self):
+        values = self._watch.read()
+        if self._built is None or values != self._watch.seen or time.monotonic() - self._built > self.max_age:
+            self.build(values)
+
+    def follow(self):
+        """
+        Returns:
+          False when the bitsets missed writes of other processes, and have
+          to be rebuilt rather than follow this process's commit
+        """
+        with self._lock:
+            return self._built is not None and self._watch.follow()
+
+    def invalidate(self):
+        with self._lock:
+            self._built = None
+
+    def link(self, tester_id, device_id, owned):
+        with self._lock:
+            if self._built is not None:
+                bitmap = self._devices.get(device_id, 0)
+                self._devices[device_id] = bitmap | (1 << tester_id) if owned else bitmap & ~(1 << tester_id)
+
+    def set_country(self, tester_id, country):
+        # None takes the tester out of every country, for deleted testers
+        with self._lock:
+            if self._built is None:
+                return
+            old = self._country_of.pop(tester_id, None)
+            if old in self._countries:
+                self._countries[old] &= ~(1 << tester_id)
+            if country is not None:
+                self._country_of[tester_id] = country
+                self._countries[country] = self._countries.get(country, 0) | (1 << tester_id)
+
+    def drop_tester(self, tester_id):
+        with self._lock:
+            if self._built is not None:
+                self.set_country(tester_id, None)
+                for device_id in self._devices:
+                    self._devices[device_id] &= ~(1 << tester_id)
+
+    def drop_device(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def owners(self, country, devices, match="all"):
+        """
+        Testers owning all or any of the devices
+
+        Args:
+          country:  The country code, or ALL for every country
+          devices:  Iterable of device ids
+          match:    "all" or "any"
+        Returns:
+          Bitmap int with the bit of every matching tester id set
+        """
+        with self._lock:
+            self._ensure_built()
+            bitmaps = [self._devices.get(d, 0) for d in normalize_devices(devices)]
+            if not bitmaps:
+                return 0
+            result = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                result = result & bitmap if match == "all" else result | bitmap
+            if country != "ALL":
+                result &= self._countries.get(country, 0)
+            return result
+
+owner_index = OwnerIndex(app.config["OWNER_INDEX_MAX_AGE"])
+
+def _looked_up(device_ids, ids, limit, offset, after):
+    # Few owners: sum their bugs by tester id and sort just them, keyed so
+    # the best tester comes first
+    e = Experience.__table__
+    totals = {}
+    for chunk in chunked(ids, LOOKUP_CHUNK):
+        totals.update((t, b) for t, b in db.session.execute(select([e.c.tester_id, func.sum(e.c.bugs)])
+            .where(and_(e.c.device_id.in_(device_ids), e.c.tester_id.in_(chunk))).group_by(e.c.tester_id)))
+    keys = ((-int(totals.get(t) or 0), t) for t in ids)
+    if after is not None:
+        keys = (k for k in keys if k > (-after[0], after[1]))
+    if limit is None:
+        return [(t, -k) for k, t in sorted(keys)[offset:]]
+    return [(t, -k) for k, t in heapq.nsmallest(offset + limit, keys)[offset:]]
+
+def _streamed(country, device_ids, owners, ids, limit, offset, after):
+    # Many owners: walk the ranking best first, keeping the owners, until
+    # the page is full
+    wanted = None if limit is None else offset + limit
+    ranked = []
+    seen = set()
+    if after is None or after[0] > 0:
+        for tester_id, total in ranking_query(country, device_ids, after).yield_per(1000):
+            seen.add(tester_id)
+            if tester_id is not None and _has(owners, tester_id):
+                ranked.append((tester_id, int(total)))
+                if wanted is not None and len(ranked) >= wanted:
+                    return ranked[offset:]
+
+    # The rest of the page are owners without bugs, in tester id order,
+    # which means knowing every tester with bugs
+    if after is not None:
+        seen.update(t for t, _ in ranking_query(country, device_ids))
+    page = ranked[offset:]
+    skip = max(offset - len(ranked), 0)
+    start = after[1] if after is not None and after[0] == 0 else 0
+    for tester_id in ids:
+        if tester_id in seen or tester_id <= start:
+            continue
+        if skip:
+            skip -= 1
+            continue
+        if limit is not None and len(page) >= limit:
+            break
+        page.append((tester_id, 0))
+    return page
+
+def rank_owners(country, devices, match="all", limit=None, offset=0, after=None):
+    """
+    Rank the testers owning all or any of the devices by bugs filed on them,
+    owners without bugs included. Ties break on tester id like
+    app.ranking.rank_testers.
+
+    Args:
+      country:  The country code, or ALL for every country
+      devices:  Iterable of device ids in the search
+      match:    "all" or "any"
+      limit:    Maximum number of testers to return, None for all of them
+      offset:   Number of top testers to skip
+      after:    Optional (total_bugs, tester_id) keyset cursor
+    Returns:
+      List of TesterRank rows like app.ranking.rank_testers
+    """
+    device_ids = normalize_devices(devices)
+    owners = _bytes(owner_index.owners(country, device_ids, match))
+    ids = list(_ids(owners))
+    if len(ids) <= app.config["OWNER_LOOKUP_MAX"]:
+        page = _looked_up(device_ids, ids, limit, offset, after)
+    else:
+        page = _streamed(country, device_ids, owners, ids, limit, offset, after)
+
+    # Breakdowns for the testers with bugs, in place
+    ranked = iter(with_breakdown([r for r in page if r[1]], device_ids))
+    return [next(ranked) if total else TesterRank(tester_id, 0, []) for tester_id, total in page]
+
+@data_changed.connect_via(app)
+def _follow(sender, changes):
+    if not owner_index.follow():
+        owner_index.invalidate()
+        return
+    for c in changes:
+        if c.table == "experience" and c.op == "rebuild":
+            # Bulk loads write the device lists without itemizing them
+            owner_index.invalidate()
+            return
+        if c.table == "association":
+            tester_id, device_id = c.key
+            owner_index.link(tester_id, device_id, c.op == "insert")
+        elif c.table == "tester" and c.op == "delete":
+            owner_index.drop_tester(c.key)
+        elif c.table == "tester":
+            owner_index.set_country(c.key, c.new["country"])
+        elif c.table == "device" and c.op == "delete":
+            owner_index.drop_device(c.key)
@@ -0,0 +1,119 @@
+from app import app, db
+from app.changes import Change, record
+from app.experience import apply_deltas
+from app.importer import chunked
+from app.models import association_table, Bug, Device, Experience, Tester
+from collections import Counter, namedtuple
+from sqlalchemy import and_, bindparam, select
+
+# Rows removed by a purge, per table. Experience counts lowered by bug
+# purges are not included, only rows that went away.
+PurgeStats = namedtuple("PurgeStats", ["bugs", "testers", "devices", "associations", "experience"])
+
+# Largest IN list sent in one statement
+LOOKUP_CHUNK = 500
+
+def _columns(table, names):
+    return [table.c.id] + [table.c[n] for n in names]
+
+def purge_bugs(where, connection=None):
+    """
+    Delete the bugs matching a filter with one DELETE, and take them off the
+    Experience counts with one summed update per tester/device pair. Runs in
+    the current transaction, the caller commits.
+
+    Up to PURGE_ITEMIZE_MAX bugs, every deleted bug is recorded as a change,
+    so caches drop just what they showed. Past that, one experience rebuild
+    change is recorded and everything derived starts over.
+
+    Args:
+      where:      Filter on the bug table, e.g. Bug.id.in_(ids)
+      connection: Connection of the transaction, db.session's by default
+    Returns:
+      PurgeStats
+    """
+    connection = connection or db.session.connection()
+    b, e = Bug.__table__, Experience.__table__
+
+    # Counted in one pass over the bugs rather than with a GROUP BY, which
+    # SQLite answers by walking the (tester_id, device_id) index and looking
+    # every bug up from it, several times slower for large purges
+    counts = Counter()
+    gone = []
+    itemize = app.config["PURGE_ITEMIZE_MAX"]
+    result = connection.execute(select(_columns(b, ("tester_id", "device_id"))).where(where))
+    for rows in result.partitions(10000):
+        counts.update((r[1], r[2]) for r in rows)
+        if gone is not None:
+            gone.extend(rows)
+            if len(gone) > itemize:
+                gone = None
+    if not counts:
+        return PurgeStats(0, 0, 0, 0, 0)
+
+    deleted = connection.execute(b.delete().where(where)).rowcount
+    if gone is not None:
+        apply_deltas(connection, {pair: -n for pair, n in counts.items()})
+        record([Change("bug", "delete", id, {"tester_id": t, "device_id": d}, None) for id, t, d in gone])
+    else:
+        connection.execute(e.update()
+            .where(and_(e.c.tester_id == bindparam("t_id"), e.c.device_id == bindparam("d_id")))
+            .values(bugs=e.c.bugs - bindparam("n")),
+            [{"t_id": t, "d_id": d, "n": n} for (t, d), n in counts.items()])
+        record([Change("experience", "rebuild", None, None, None)])
+    return PurgeStats(deleted, 0, 0, 0, 0)
+
+def _purge_parents(table, key, where, fields, connection):
+    # Testers and devices go with their bugs, device links and Experience
+    # rows, children first, a chunk of ids at a time. The foreign keys
+    # cascade as well, this keeps the counts and works whether or not the
+    # database enforces them. Removed device links are recorded one by one,
+    # the bugs and Experience rows are implied by the parent's delete.
+    b, e, a = Bug.__table__, Experience.__table__, association_table
+    rows = connection.execute(select(_columns(table, fields)).where(where)).fetchall()
+    counts = Counter()
+    changes = []
+    for chunk in chunked([r[0] for r in rows], LOOKUP_CHUNK):
+        links = connection.execute(select([a.c.tester_id, a.c.device_id]).where(a.c[key].in_(chunk))).fetchall()
+        changes.extend(Change("association", "delete", (t, d), {"tester_id": t, "device_id": d}, None) for t, d in links)
+        counts["bugs"] += connection.execute(b.delete().where(b.c[key].in_(chunk))).rowcount
+        counts["experience"] += connection.execute(e.delete().where(e.c[key].in_(chunk))).rowcount
+        counts["associations"] += connection.execute(a.delete().where(a.c[key].in_(chunk))).rowcount
+        counts["parents"] += connection.execute(table.delete().where(table.c.id.in_(chunk))).rowcount
+    changes.extend(Change(table.name, "delete", r[0], dict(zip(fields, r[1:])), None) for r in rows)
+    record(changes)
+    return counts
+
+def purge_testers(where, connection=None):
+    """
+    Delete the testers matching a filter, with their bugs, device links and
+    Experience rows, in a few set based statements. Runs in the current
+    transaction, the caller commits.
+
+    Args:
+      where:      Filter on the tester table, e.g.
+                  Tester.last_login < datetime(2013, 1, 1)
+      connection: Connection of the transaction, db.session's by default
+    Returns:
+      PurgeStats
+    """
+    connection = connection or db.session.connection()
+    counts = _purge_parents(Tester.__table__, "tester_id", where,
+        ("first_name", "last_name", "country", "last_login"), connection)
+    return PurgeStats(counts["bugs"], counts["parents"], 0, counts["associations"], counts["experience"])
+
+def purge_devices(where, connection=None):
+    """
+    Delete the devices matching a filter, with their bugs, tester links and
+    Experience rows, in a few set based statements. Runs in the current
+    transaction, the caller commits.
+
+    Args:
+      where:      Filter on the device table, e.g. Device.id.in_(ids)
+      connection: Connection of the transaction, db.session's by default
+    Returns:
+      PurgeStats
+    """
+    connection = connection or db.session.connection()
+    counts = _purge_parents(Device.__table__, "device_id", where, ("device_name",), connection)
+    return PurgeStats(counts["bugs"], 0, counts["parents"], counts["associations"], counts["experience"])
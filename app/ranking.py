@@ -0,0 +1,139 @@
+import itertools
+
+from app import db
+from app.leaderboard import top_testers
+from app.models import Experience, Tester
+from collections import namedtuple
+from sqlalchemy import and_, func, or_
+
+# One ranked tester: their id, the bugs filed across all searched devices, and
+# the per device breakdown as a list of DeviceBugs
+TesterRank = namedtuple("TesterRank", ["tester_id", "total_bugs", "experiences"])
+DeviceBugs = namedtuple("DeviceBugs", ["device_id", "bugs"])
+
+def normalize_devices(devices):
+    """
+    Turn the device ids of a search into a sorted list of unique integers
+
+    Args:
+      devices:  Iterable of device ids, as ints or strings
+    Returns:
+      Sorted list of unique integer device ids
+    """
+    return sorted({int(d) for d in devices})
+
+def ranking_query(country, device_ids, after=None):
+    """
+    Build the aggregate query ranking testers for a search. Bugs are summed
+    per tester in the database, so only one row per tester ever comes back.
+
+    Args:
+      country:    The country code, or ALL for every country
+      device_ids: List of integer device ids in the search
+      after:      Optional (total_bugs, tester_id) keyset cursor, only testers
+                  ranked after it are returned
+    Returns:
+      A query of (tester_id, total_bugs) rows, best testers first
+    """
+    total = func.sum(Experience.bugs).label("total_bugs")
+    q = db.session.query(Experience.tester_id, total).filter(Experience.device_id.in_(device_ids)) \
+        .filter(Experience.tester_id.isnot(None))
+
+    # Only join the testers table when we actually need to filter on it
+    if country != "ALL":
+        q = q.join(Tester, Tester.id == Experience.tester_id).filter(Tester.country == country)
+
+    # Ties are broken on tester id so pages are stable
+    having = total > 0
+    if after is not None:
+        having = and_(having, or_(total < after[0], and_(total == after[0], Experience.tester_id > after[1])))
+    return q.group_by(Experience.tester_id).having(having).order_by(total.desc(), Experience.tester_id)
+
+def rank_testers(country, devices, limit=None, offset=0, after=None):
+    """
+    Rank the testers with the most bugs filed on the given devices
+
+    Args:
+      country:  The country code, or ALL for every country
+      devices:  Iterable of device ids in the search
+      limit:    Maximum number of testers to return, None for all of them
+      offset:   Number of top testers to skip, for pagination
+      after:    Optional (total_bugs, tester_id) keyset cursor, only testers
+                ranked after it are returned
+    Returns:
+      List of TesterRank rows in descending order of bugs filed
+    """
+    device_ids = normalize_devices(devices)
+    if not device_ids:
+        return []
+
+    # Common searches are answered from the leaderboard rollup, the others
+    # with one grouped query for the ordering, the database does the sorting
+    ranked = top_testers(country, device_ids, limit=limit, offset=offset, after=after)
+    if ranked is None:
+        q = ranking_query(country, device_ids, after)
+        if limit is not None:
+            q = q.limit(limit)
+        if offset:
+            q = q.offset(offset)
+        ranked = q.all()
+    return with_breakdown(ranked, device_ids)
+
+def iter_rankings(country, devices, limit=None, after=None, chunk_size=500):
+    """
+    Stream a ranking in chunks off one query, so arbitrarily many testers can
+    be walked through in bounded memory
+
+    Args:
+      country:    The country code, or ALL for every country
+      devices:    Iterable of device ids in the search
+      limit:      Maximum number of testers, None for all of them
+      after:      Optional (total_bugs, tester_id) keyset cursor
+      chunk_size: Number of testers fetched and yielded at a time
+    Yields:
+      Lists of at most chunk_size TesterRank rows, best testers first
+    """
+    device_ids = normalize_devices(devices)
+    if not device_ids:
+        return
+    q = ranking_query(country, device_ids, after)
+    if limit is not None:
+        q = q.limit(limit)
+    # yield_per streams rows off a server side cursor where the database has
+    # one, instead of buffering the whole result
+    ranked = iter(q.yield_per(chunk_size))
+    while True:
+        chunk = list(itertools.islice(ranked, chunk_size))
+        if not chunk:
+            return
+        yield with_breakdown(chunk, device_ids)
+
+def with_breakdown(ranked, device_ids):
+    """
+    Attach the per device bug counts to ranked testers with one query
+
+    Args:
+      ranked:     List of (tester_id, total_bugs) rows
+      device_ids: List of integer device ids in the search
+    Returns:
+      List of TesterRank rows in the same order
+    """
+    if not ranked:
+        return []
+
+    # A single device's count is the tester's total
+    if len(device_ids) == 1:
+        return [TesterRank(tester_id, int(total), [DeviceBugs(device_ids[0], int(total))]) for tester_id, total in ranked]
+
+    # One more query for the per device breakdown of just these testers,
+    # devices they have no bugs on are left out
+    breakdown = {tester_id: [] for tester_id, _ in ranked}
+    exps = db.session.query(Experience.tester_id, Experience.device_id, Experience.bugs) \
+        .filter(Experience.tester_id.in_(list(breakdown))) \
+        .filter(Experience.device_id.in_(device_ids)) \
+        .filter(Experience.bugs > 0) \
+        .order_by(Experience.device_id)
+    for tester_id, device_id, bugs in exps:
+        breakdown[tester_id].append(DeviceBugs(device_id, bugs))
+
+    return [TesterRank(tester_id, int(total), breakdown[tester_id]) for tester_id, total in ranked]
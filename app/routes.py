@@ -1,22 +1,42 @@
-import operator
-import random
-
 from app import app, db
-from app.forms import BugForm, DeviceForm, AddTesterForm, ConfirmForm, DevForm, EditTesterForm, getDevices, SearchForm
-from app.models import Bug, Device, Experience, Tester
+from app.cache import search_cache
+from app.catalog import device_catalog
+from app.database import read_only
+from app.forms import BugForm, DeviceForm, AddTesterForm, ConfirmForm, DevForm, EditTesterForm, SearchForm
+from app.matrix import match_index, use_match_index
+from app.models import Bug, Device, Tester
+from app.owners import MATCH_MODES, rank_owners
+from app.purge import purge_bugs, purge_devices, purge_testers
+from app.ranking import normalize_devices
+from app.sampling import page_rows, sample_rows
+from app.versions import bug_version, cacheable, device_version, not_modified, results_version, tester_version
+from app.viewmodels import bug_rows, device_rows, result_rows, tester_rows
 from datetime import datetime
-from flask import flash, redirect, render_template, request, url_for
+from flask import flash, jsonify, redirect, render_template, request, url_for
 
 @app.route('/', methods=['GET','POST'])
 @app.route('/index', methods=['GET','POST'])
+@read_only
 def index():
     """
     Homepage that shows some testers, bugs, and devices.
+
+    Query args:
+      page: Which page of INDEX_PAGE_SIZE testers and devices to show
     """
-    # Query desired data and pass into html template
-    return render_template("index.html", title="Home", bugs=random.choices(db.session.query(Bug).all(), k=10), devices=db.session.query(Device).all(), testers=db.session.query(Tester).all(), db=db, Tester=Tester, Device=Device, Bug=Bug)
+    # Show a page of testers and devices at a time, and a random sample of
+    # bugs picked without loading the whole table
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = app.config["INDEX_PAGE_SIZE"]
+    testers, has_next = page_rows(db.session.query(Tester), Tester.id, page, per_page)
+    devices = device_rows()
+    has_next = has_next or len(devices) > page * per_page
+    devices = devices[(page - 1) * per_page:page * per_page]
+    bugs = sample_rows(Bug, 10)
+    return render_template("index.html", title="Home", bugs=bug_rows(bugs), devices=devices, testers=tester_rows(testers), page=page, has_next=has_next)
 
 @app.route('/results/<country>/<devices>', methods=['GET','POST'])
+@read_only
 def results(country, devices):
     """
     The page that holds all search results. Multiple devices chosen using shift
@@ -24,56 +44,49 @@ def results(country, devices):
 
     Args:
       country: The country code specified in search parameters
-      devices: An array including all device IDs in search
+      devices: Comma separated device IDs in search
+    Query args:
+      page:    Which page of RESULTS_PER_PAGE testers to show, starting at 1
+      engine:  sql or matrix, to pick the search engine over MATCH_ENGINE
+      match:   all or any, to list the testers owning all or any of the
+               devices, with or without bugs on them, instead of the testers
+               with bugs on them
     Returns:
       Testers in descending order of the most experience in the given region 
       with the devices specified.
     """
-    # Initialize form for searching
-    form = SearchForm(country=country,device=devices)
+    # Nothing was written since the client's copy, so it is still right
+    validators = results_version()
+    unchanged = not_modified(validators)
+    if unchanged:
+        return unchanged
+
+    # Initialize form for searching, devices in the url are comma separated
+    form = SearchForm(country=country, device=devices.split(","))
 
     # Reset the country and devices variables on the fly
     country = form.country.data
-    devices = form.device.data
-
-    # Initialize the total bugs filed count and experience lists
-    count = {}
-    exps = {}
-
-    # Whether or not to add an additional filter to the query
-    if country == 'ALL':
-        # Loop through all device_id values in the search
-        for d in devices:
-            # Query all the values that fit the criteria, and sort them by 
-            # number of bugs
-            q = db.session.query(Experience).filter_by(device_id=int(d)).all()
-
-            # Loop through experiences, and add the new bugs to count and 
-            # related experiences to exps
-            for e in q:
-                if e.tester_id in count.keys():
-                    count[e.tester_id] += e.bugs
-                    exps[e.tester_id].append(e)
-                else:
-                    count[e.tester_id] = e.bugs
-                    exps[e.tester_id] = [e]
+    devices = normalize_devices(form.device.data)
+
+    # Grab one extra tester past the page to know if there is a next page
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = app.config["RESULTS_PER_PAGE"]
+    match = request.args.get("match")
+    if match not in MATCH_MODES:
+        match = None
+    if match:
+        ranking = rank_owners(country, devices, match, limit=per_page + 1, offset=(page - 1) * per_page)
+    elif use_match_index(request.args.get("engine")):
+        ranking = match_index.rank_testers(country, devices, limit=per_page + 1, offset=(page - 1) * per_page)
     else:
-        # Very similar to loop above, with an extra filter for country code
-        for d in devices:
-            q = db.session.query(Experience).filter(Experience.tester.has(country=form.country.data)).filter_by(device_id=int(d)).all()
-            for e in q:
-                if e.tester_id in count.keys():
-                    count[e.tester_id] += e.bugs
-                    exps[e.tester_id].append(e)
-                else:
-                    count[e.tester_id] = e.bugs
-                    exps[e.tester_id] = [e]
-
-    # Sort the bugs count in descending order, saving the mapping
-    ordering = reversed(sorted(count.items(), key=operator.itemgetter(1)))
-    return render_template("results.html", title="Results", count=count, exps=exps, ordering=ordering, search=form, db=db, Tester=Tester, Device=Device)
+        ranking = search_cache.rank_testers(country, devices, limit=per_page + 1, offset=(page - 1) * per_page)
+    has_next = len(ranking) > per_page
+    ranking = ranking[:per_page]
+
+    return cacheable(render_template("results.html", title="Results", results=result_rows(ranking), page=page, has_next=has_next, country=country, devices=",".join(str(d) for d in devices), match=match, search=form), validators)
 
 @app.route("/bug/<id>", methods=['GET','POST'])
+@read_only
 def bug(id):
     """
     A page to display data about bugs
@@ -83,6 +96,12 @@ def bug(id):
     Returns:
       Tester and device data about the bug filed
     """
+    # Answer polls for an unchanged bug without loading or rendering it
+    validators = bug_version(id)
+    unchanged = not_modified(validators)
+    if unchanged:
+        return unchanged
+
     # Grab the bug in question
     bug = db.session.query(Bug).filter_by(id=id).first()
 
@@ -92,11 +111,10 @@ def bug(id):
         return redirect(url_for("index"))
     else:
         # If found, grab the tester and device info and render
-        tester = db.session.query(Tester).filter_by(id=bug.tester_id).first()
-        device = db.session.query(Device).filter_by(id=bug.device_id).first().device_name
-        return render_template("bug.html", title="Bug Report", bug=bug, tester=tester.first_name+tester.last_name, device=device, db=db, Tester=Tester, Device=Device, Bug=Bug, Experience=Experience)
+        return cacheable(render_template("bug.html", title="Bug Report", bug=bug_rows([bug])[0]), validators)
 
 @app.route("/device/<id>", methods=['GET','POST'])
+@read_only
 def device(id):
     """
     A page to display data about devices
@@ -106,17 +124,23 @@ def device(id):
     Returns:
       Device name
     """
-    # Grab the device in question
-    device = db.session.query(Device).filter_by(id=id).first()
+    validators = device_version(int(id)) if id.isdigit() else None
+    unchanged = not_modified(validators)
+    if unchanged:
+        return unchanged
+
+    # Grab the device name in question from the catalog
+    device = device_catalog.names().get(int(id)) if id.isdigit() else None
 
     # Check for its lively existence, and render appropriate pages as needed
     if device is None:
         flash("Device ID Invalid")
         return redirect(url_for("index"))
     else:
-        return render_template("device.html", title="Device Info", device=device.device_name, db=db, Tester=Tester, Device=Device, Bug=Bug, Experience=Experience)
+        return cacheable(render_template("device.html", title="Device Info", device=device), validators)
 
 @app.route("/tester/<id>", methods=['GET','POST'])
+@read_only
 def tester(id):
     """
     A page to display data about Testers
@@ -127,12 +151,17 @@ def tester(id):
       All known tester data, both names, country, last known login, and devices 
       they are familiar with
     """
+    validators = tester_version(id)
+    unchanged = not_modified(validators)
+    if unchanged:
+        return unchanged
+
     tester = db.session.query(Tester).filter_by(id=id).first()
     if tester is None:
         flash("Tester ID Invalid")
         return redirect(url_for("index"))
     else:
-        return render_template("tester.html", title="Tester Profile", tester=tester, db=db, Tester=Tester, Device=Device, Bug=Bug, Experience=Experience)
+        return cacheable(render_template("tester.html", title="Tester Profile", tester=tester_rows([tester])[0], devices=device_rows(tester.devices)), validators)
 
 @app.route("/devtools", methods=['GET','POST'])
 def devtools():
@@ -166,6 +195,13 @@ def devtools():
             return redirect(url_for("devtools"))
     return render_template("devtools.html", title="Devtools", form=form)
 
+@app.route("/devtools/cache")
+def cache_stats():
+    """
+    Hit and miss counters of this process's search cache, for sizing it
+    """
+    return jsonify(search_cache.stats())
+
 @app.route("/add/<obj>", methods=['GET','POST'])
 def add(obj):
     """
@@ -183,22 +219,9 @@ def add(obj):
             # Create an instance of the bug
             bug = Bug(device_id=int(form.device_id.data), tester_id=int(form.tester_id.data))
 
-            # Add to the database
+            # Add to the database, the Experience count follows along in the
+            # same transaction
             db.session.add(bug)
-
-            # Check if the experience for this device/tester combo exists
-            exp = db.session.query(Experience).filter_by(device_id=int(form.device_id.data)).filter(Experience.tester.id == int(form.tester_id.data)).first()
-
-            # If it's new, make an instance of it, and append it to the 
-            # relevanet tester
-            if exp is None:
-                exp = Experience(device_id = int(form.device_id.data), bugs=1)
-                db.session.query(Tester).filter_by(id=int(form.tester_id.data)).first().experience.append(exp)
-            else:
-                # If it's not, increment the number of bugs found for that 
-                # experience
-                exp.bugs += 1
-            # Commit all changes 
             db.session.commit()
 
             # Confirm addition and render
@@ -263,19 +286,8 @@ def edit(obj, id):
             if bug.device_id == int(form.device_id.data) and bug.tester_id == int(form.tester_id.data):
                 flash("Please change some parameters")
                 return redirect(url_for("edit", obj="Bug", id=id))
-            # Decrement the bug from the experience it was originally part of
-            exp = db.session.query(Experience).filter_by(device_id=int(bug.device_id)).filter(Experience.tester.id == bug.tester_id).first()
-            exp.bugs -= 1
-
-            # Then increment the bug count of the experience it is now part of
-            exp = db.session.query(Experience).filter_by(device_id=int(form.device_id.data)).filter(Experience.tester.id == int(form.tester_id.data)).first()
-            if exp is None:
-                exp = Experience(device_id = int(form.device_id.data), bugs=1)
-                db.session.query(Tester).filter_by(id=int(form.tester_id.data)).first().experience.append(exp)
-            else:
-                exp.bugs += 1
-
-            # Make changes, commit, and redirect
+            # Make changes, commit, and redirect. The bug moves from its old
+            # experience to the new one in the same transaction
             bug.device_id = int(form.device_id.data)
             bug.tester_id = int(form.tester_id.data)
             db.session.commit()
@@ -339,17 +351,24 @@ def delete(obj, id):
     if form.validate_on_submit():
         # Check user is sure
         if form.areYouSure.data:
-            # If so, delete, commit, confirm, redirect
+            # If so, delete along with everything hanging off it, commit,
+            # confirm, redirect
             if obj == "Bug":
-                db.session.delete(db.session.query(Bug).filter_by(id=id).first())
+                stats = purge_bugs(Bug.id == id)
             elif obj == "Device":
-                db.session.delete(db.session.query(Device).filter_by(id=id).first())
+                stats = purge_devices(Device.id == id)
             elif obj == "Tester":
-                db.session.delete(db.session.query(Tester).filter_by(id=id).first())
+                stats = purge_testers(Tester.id == id)
             else:
                 flash("Object type not recognized")
                 return redirect(url_for("devtools"))
             db.session.commit()
+            if not any(stats):
+                flash("No " + obj + " with ID " + str(id))
+            else:
+                flash("{} deleted with {} bugs, {} experience rows and {} device links".format(
+                    obj, stats.bugs, stats.experience, stats.associations))
+            return redirect(url_for("devtools"))
         else:
             return redirect(url_for("devtools"))
     return render_template("delete.html", title="Delete " + obj, form=form)
\ No newline at end of file
@@ -0,0 +1,58 @@
+import random
+
+from app import db
+from sqlalchemy import func
+
+def sample_rows(model, k, rng=random):
+    """
+    Pick up to k distinct random rows of a model without scanning its table.
+    Random ids are drawn between the smallest and largest id (both read off
+    the primary key index) and fetched with one IN query. Ids that fell into
+    gaps are topped up by seeking to the first row at or after a random id.
+
+    Args:
+      model:  A model with an integer id primary key
+      k:      Number of rows wanted
+      rng:    Source of randomness, the random module by default
+    Returns:
+      List of at most k model instances, fewer when the table is smaller or
+      its ids are very sparse
+    """
+    # Two separate queries, as SQLite only answers a lone MIN or MAX straight
+    # from the index
+    lo = db.session.query(func.min(model.id)).scalar()
+    hi = db.session.query(func.max(model.id)).scalar()
+    if lo is None or hi is None or k <= 0:
+        return []
+
+    # Dense id ranges are answered by the first query almost every time
+    wanted = set(rng.randint(lo, hi) for _ in range(2 * k))
+    rows = {row.id: row for row in db.session.query(model).filter(model.id.in_(wanted))}
+
+    # Gaps in the ids, seek forward a bounded number of times. Rows deleted
+    # since lo and hi were read can leave nothing at or after the seek
+    for _ in range(4 * k):
+        if len(rows) >= k:
+            break
+        row = db.session.query(model).filter(model.id >= rng.randint(lo, hi)).order_by(model.id).first()
+        if row is not None:
+            rows.setdefault(row.id, row)
+
+    rows = list(rows.values())
+    rng.shuffle(rows)
+    return rows[:k]
+
+def page_rows(query, order_by, page, per_page):
+    """
+    Fetch one page of a query plus one extra row to know if more pages follow
+
+    Args:
+      query:    The query to page through
+      order_by: Column keeping the pages stable
+      page:     Page number, starting at 1
+      per_page: Number of rows per page
+    Returns:
+      Tuple of the page's rows and whether there is a next page
+    """
+    rows = query.order_by(order_by).limit(per_page + 1).offset((page - 1) * per_page).all()
+    return rows[:per_page], len(rows) > per_page
@@ -0,0 +1,249 @@
+import threading
+
+from app import db
+from app.changes import changes_recorded
+from app.models import Bug, Device, Generation, Tester
+from datetime import datetime, timezone
+from flask import make_response, request, session as user_session
+from sqlalchemy import event, inspect, select
+
+# Every row of Bug, Tester and Device carries a version bumped by each
+# UPDATE, and the generation table counts writes per table. Pages build
+# their ETag and Last-Modified from these, so a client polling an unchanged
+# page gets a 304 after one small query and no rendering.
+#
+# A row deleted and inserted again with the same id starts over at version
+# 1, so pages also carry a counter of deletes of their table, which never
+# goes back. Deleting a tester or device deletes its bugs too, and rebuilds
+# (imports, large purges) count as deleting everything.
+DELETES = {
+    "bug": ("bug-deletes",),
+    "tester": ("tester-deletes", "bug-deletes"),
+    "device": ("device-deletes", "bug-deletes"),
+}
+
+# The counters moved by the last commit of each thread, for the
+# data_changed listeners it runs, see GenerationWatch.follow
+_last_commit = threading.local()
+
+@event.listens_for(db.session, "before_flush")
+def _touch_testers(session, flush_context, instances):
+    # Changing a tester's devices only writes the association table, so
+    # touch the tester to bump its version too
+    for obj in session.dirty:
+        if isinstance(obj, Tester):
+            state = inspect(obj)
+            if "devices" in state.dict and state.attrs.devices.history.has_changes():
+                obj.updated_at = datetime.utcnow()
+
+@changes_recorded.connect
+def _bump(session, changes):
+    names = {c.table for c in changes} | {"all"}
+    for c in changes:
+        if c.op == "delete" and c.table in DELETES:
+            names.update(DELETES[c.table])
+        elif c.op == "rebuild":
+            names.update(("bug-deletes", "tester-deletes", "device-deletes"))
+    table = Generation.__table__
+    now = datetime.utcnow()
+    connection = session.connection()
+    result = connection.execute(table.update().where(table.c.name.in_(names))
+        .values(value=table.c.value + 1, updated_at=now))
+
+    # Counters are created on first use when the migration did not add them
+    if result.rowcount < len(names):
+        existing = {n for n, in connection.execute(select([table.c.name]).where(table.c.name.in_(names)))}
+        missing = [{"name": n, "value": 1, "updated_at": now} for n in names - existing]
+        if missing:
+            connection.execute(table.insert(), missing)
+
+    # What the transaction moves each counter from and to. The rows stay
+    # locked until it ends, so no other write comes in between
+    moved = session.info.setdefault("generations", {})
+    for name, value in connection.execute(select([table.c.name, table.c.value]).where(table.c.name.in_(names))):
+        moved[name] = (moved[name][0] if name in moved else value - 1, value)
+
+@event.listens_for(db.session, "after_commit", insert=True)
+def _committed(session):
+    # Runs ahead of the data_changed listeners of app.changes
+    _last_commit.moved = session.info.pop("generations", {})
+
+@event.listens_for(db.session, "after_rollback")
+def _rolled_back(session):
+    session.info.pop("generations", None)
+
+def generation(name="all"):
+    """
+    Returns:
+      (value, updated_at) of a generation counter, (0, None) before any write
+    """
+    row = db.session.query(Generation.value, Generation.updated_at).filter_by(name=name).first()
+    return tuple(row) if row else (0, None)
+
+class GenerationWatch(object):
+    """
+    The generation counters an in process copy of some tables (a cache or an
+    index) was loaded at. The pages' validators are built from the same
+    counters, so checking them before answering keeps what a worker renders
+    in step with the ETag it sends, whichever process made the writes.
+
+    Writes committed by this process are applied to the copy by its
+    data_changed listener, which calls follow() first to move the watch on
+    with them rather than loading everything again.
+
+    Example:
+      watch = GenerationWatch("tester", "association")
+      if not watch.current():
+          values = watch.read()
+          ... load the copy ...
+          watch.loaded(values)
+    """
+    def __init__(self, *names):
+        self.names = names
+        self.seen = None
+
+    def read(self):
+        """
+        Returns:
+          Dict of the watched counters' current values, to hand to loaded()
+          once the copy is loaded. Read them before loading it, so writes
+          committed in between make it load again rather than be missed.
+        """
+        values = dict(db.session.query(Generation.name, Generation.value).filter(Generation.name.in_(self.names)))
+        return {n: values.get(n, 0) for n in self.names}
+
+    def loaded(self, values):
+        self.seen = values
+
+    def reset(self):
+        self.seen = None
+
+    def current(self):
+        """
+        Returns:
+          True when nothing the copy did not follow was written since it
+          was loaded
+        """
+        return self.seen is not None and self.read() == self.seen
+
+    def follow(self):
+        """
+        Move on with the commit this process just made, from a data_changed
+        listener, before applying its changes
+
+        Returns:
+          False when the copy has to be loaded again instead, because it
+          missed writes committed before this one
+        """
+        if self.seen is None:
+            return False
+        moved = getattr(_last_commit, "moved", {})
+        moved = {n: moved[n] for n in self.names if n in moved}
+        if any(self.seen[n] != before for n, (before, _) in moved.items()):
+            self.seen = None
+            return False
+        seen = dict(self.seen)
+        seen.update((n, after) for n, (_, after) in moved.items())
+        self.seen = seen
+        return True
+
+def _latest(*times):
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+def tester_version(id):
+    """
+    Validators of a tester page: the tester's own version, bumped when its
+    fields or devices change, the device generation for renames, and the
+    tester delete counter
+
+    Returns:
+      (etag, last_modified), or None when there is no such tester
+    """
+    row = db.session.query(Tester.version, Tester.updated_at).filter_by(id=id).first()
+    if row is None:
+        return None
+    devices, devices_at = generation("device")
+    deletes, deletes_at = generation("tester-deletes")
+    return "tester-{}-{}-{}-{}".format(id, row.version, devices, deletes), _latest(row.updated_at, devices_at, deletes_at)
+
+def bug_version(id):
+    """
+    Validators of a bug page, which shows the bug's tester and device names.
+    Testers and devices cannot be deleted without their bugs, so the bug
+    delete counter covers them too
+
+    Returns:
+      (etag, last_modified), or None when there is no such bug
+    """
+    row = db.session.query(Bug.version, Bug.updated_at, Tester.version, Tester.updated_at, Device.version, Device.updated_at) \
+        .outerjoin(Tester, Tester.id == Bug.tester_id).outerjoin(Device, Device.id == Bug.device_id) \
+        .filter(Bug.id == id).first()
+    if row is None:
+        return None
+    deletes, deletes_at = generation("bug-deletes")
+    return "bug-{}-{}-{}-{}-{}".format(id, row[0], row[2], row[4], deletes), _latest(row[1], row[3], row[5], deletes_at)
+
+def device_version(id):
+    """
+    Returns:
+      (etag, last_modified) of a device page, or None when there is no such
+      device
+    """
+    row = db.session.query(Device.version, Device.updated_at).filter_by(id=id).first()
+    if row is None:
+        return None
+    deletes, deletes_at = generation("device-deletes")
+    return "device-{}-{}-{}".format(id, row.version, deletes), _latest(row.updated_at, deletes_at)
+
+def results_version():
+    """
+    Validators of a results page, which any write may change
+    """
+    value, updated_at = generation()
+    return "results-{}".format(value), updated_at
+
+def not_modified(validators):
+    """
+    A 304 response when the client's copy of a GET page is current
+
+    Args:
+      validators: (etag, last_modified) of the page, or None
+    Returns:
+      The 304 response, or None when the page has to be rendered
+    """
+    # Flashed messages are shown once, so a page with some pending is fresh
+    if validators is None or request.method != "GET" or user_session.get("_flashes"):
+        return None
+    etag, last_modified = validators
+    if request.if_none_match:
+        current = request.if_none_match.contains(etag)
+    else:
+        # Stored times are naive UTC, HTTP dates have whole seconds
+        current = last_modified is not None and request.if_modified_since is not None \
+            and request.if_modified_since >= last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+    if not current:
+        return None
+    return cacheable("", validators, status=304)
+
+def cacheable(body, validators, status=200):
+    """
+    Attach the validators to a rendered page. Caches may store it but have to
+    check it is current before reusing it, and keep copies per session since
+    pages embed the session's CSRF token.
+
+    Args:
+      body:       The rendered page
+      validators: (etag, last_modified) of the page
+      status:     HTTP status code
+    Returns:
+      The response
+    """
+    response = make_response(body, status)
+    etag, last_modified = validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add("Cookie")
+    return response
@@ -0,0 +1,117 @@
+from app import db
+from app.catalog import device_catalog
+from app.models import Tester
+from collections import namedtuple
+
+# Plain rows handed to the templates. Everything a template shows is looked up
+# here in bulk (device names come from the in memory catalog), so templates
+# never need a database session.
+TesterRow = namedtuple("TesterRow", ["id", "name", "country", "last_login"])
+DeviceRow = namedtuple("DeviceRow", ["id", "device_name"])
+BugRow = namedtuple("BugRow", ["id", "tester_id", "tester_name", "device_id", "device_name"])
+ExperienceRow = namedtuple("ExperienceRow", ["tester_id", "tester_name", "device_id", "device_name", "bugs"])
+ResultRow = namedtuple("ResultRow", ["tester_id", "tester_name", "total_bugs", "experiences"])
+
+def tester_names(ids):
+    """
+    Look up the display names of many testers with a single IN query
+
+    Args:
+      ids:  Iterable of tester ids
+    Returns:
+      Dict of tester id to display name, missing testers are left out
+    """
+    ids = set(ids)
+    if not ids:
+        return {}
+    return {t.id: t.name() for t in db.session.query(Tester).filter(Tester.id.in_(ids))}
+
+def device_names(ids):
+    """
+    Look up the names of many devices in the in memory device catalog
+
+    Args:
+      ids:  Iterable of device ids
+    Returns:
+      Dict of device id to device name, missing devices are left out
+    """
+    names = device_catalog.names()
+    return {i: names[i] for i in set(ids) if i in names}
+
+def _tester_name(names, tester_id):
+    # Fall back on the id for rows pointing at a tester that no longer exists
+    return names.get(tester_id, "Unknown tester " + str(tester_id))
+
+def _device_name(names, device_id):
+    return names.get(device_id, "Unknown device " + str(device_id))
+
+def tester_rows(testers):
+    """
+    Args:
+      testers:  Iterable of Tester objects
+    Returns:
+      List of TesterRow
+    """
+    return [TesterRow(t.id, t.name(), t.country, t.last_login) for t in testers]
+
+def device_rows(devices=None):
+    """
+    Args:
+      devices:  Iterable of Device objects, or None for every device in the
+                catalog
+    Returns:
+      List of DeviceRow
+    """
+    if devices is None:
+        return [DeviceRow(i, name) for i, name in device_catalog.names().items()]
+    return [DeviceRow(d.id, d.device_name) for d in devices]
+
+def bug_rows(bugs):
+    """
+    Build bug rows, fetching every referenced tester in one query and the
+    device names from the catalog
+
+    Args:
+      bugs: Iterable of Bug objects
+    Returns:
+      List of BugRow
+    """
+    bugs = list(bugs)
+    testers = tester_names(b.tester_id for b in bugs)
+    devices = device_names(b.device_id for b in bugs)
+    return [BugRow(b.id, b.tester_id, _tester_name(testers, b.tester_id), b.device_id, _device_name(devices, b.device_id)) for b in bugs]
+
+def experience_rows(experiences):
+    """
+    Build experience rows, fetching every referenced tester in one query and
+    the device names from the catalog
+
+    Args:
+      experiences:  Iterable of Experience objects
+    Returns:
+      List of ExperienceRow
+    """
+    experiences = list(experiences)
+    testers = tester_names(e.tester_id for e in experiences)
+    devices = device_names(e.device_id for e in experiences)
+    return [ExperienceRow(e.tester_id, _tester_name(testers, e.tester_id), e.device_id, _device_name(devices, e.device_id), e.bugs) for e in experiences]
+
+def result_rows(ranking):
+    """
+    Build search result rows from a ranking, fetching the names of every
+    tester on the page in one query and the device names from the catalog
+
+    Args:
+      ranking:  List of TesterRank rows from app.ranking
+    Returns:
+      List of ResultRow, each holding a tuple of ExperienceRows for the
+      breakdown
+    """
+    testers = tester_names(r.tester_id for r in ranking)
+    devices = device_names(e.device_id for r in ranking for e in r.experiences)
+    rows = []
+    for r in ranking:
+        name = _tester_name(testers, r.tester_id)
+        exps = tuple(ExperienceRow(r.tester_id, name, e.device_id, _device_name(devices, e.device_id), e.bugs) for e in r.experiences)
+        rows.append(ResultRow(r.tester_id, name, r.total_bugs, exps))
+    return rows
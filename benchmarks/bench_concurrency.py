@@ -0,0 +1,97 @@
+"""
+Benchmark throughput under a mixed read/write load from several processes,
+with the default SQLite setup against the engine settings in config.py.
+
+Generates one synthetic database, then for each setup runs --workers
+processes against its own copy for --seconds. Each worker sends searches and
+tester pages, and files a bug with probability --writes, through the Flask
+test client. Reports requests per second and failed requests (e.g. "database
+is locked") per setup.
+
+Run from the repository root:
+
+    python benchmarks/bench_concurrency.py --workers 8 --writes 0.2
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+
+# Environment of each setup: SQLite defaults (rollback journal, no waiting on
+# locks, full sync), then WAL with a busy timeout and normal sync
+SETUPS = [
+    ("rollback journal", {"SQLITE_WAL": "0", "SQLITE_BUSY_TIMEOUT": "0", "SQLITE_SYNCHRONOUS": "FULL"}),
+    ("wal + busy_timeout", {"SQLITE_WAL": "1", "SQLITE_BUSY_TIMEOUT": "5000", "SQLITE_SYNCHRONOUS": "NORMAL"}),
+]
+
+def worker(args):
+    # Runs in a fresh process, so the app is configured from the environment
+    path, env, seconds, writes, seed = args
+    os.environ.update(env, DATABASE_URL="sqlite:///" + path)
+    from app import app
+    app.config["WTF_CSRF_ENABLED"] = False
+    # Failures are counted rather than logged
+    app.logger.disabled = True
+    client = app.test_client()
+    rng = random.Random(seed)
+    counts = {"reads": 0, "writes": 0, "failed": 0}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if rng.random() < writes:
+            kind = "writes"
+            response = client.post("/add/Bug", data={"device_id": rng.randint(1, 10), "tester_id": rng.randint(1, 100)})
+        else:
+            kind = "reads"
+            if rng.random() < 0.5:
+                response = client.get("/results/{}/{}".format(rng.choice(["ALL", "US", "GB"]), rng.randint(1, 10)))
+            else:
+                response = client.get("/tester/{}".format(rng.randint(1, 100)))
+        counts["failed" if response.status_code >= 500 else kind] += 1
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bugs", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--writes", type=float, default=0.2, help="Share of requests that file a bug")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    base = os.path.join(directory, "base.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + base
+    from app import app, db
+    with app.app_context():
+        synthetic.create_schema()
+        synthetic.generate(args.bugs, seed=args.seed, log=lambda message: None)
+        db.session.remove()
+        db.engine.dispose()
+
+    # Leave WAL so every copy starts out as a single rollback journal file
+    conn = sqlite3.connect(base)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+    context = multiprocessing.get_context("spawn")
+    for name, env in SETUPS:
+        path = os.path.join(directory, name.replace(" ", "_").replace("+", "") + ".db")
+        shutil.copy(base, path)
+        jobs = [(path, env, args.seconds, args.writes, args.seed + i) for i in range(args.workers)]
+        with context.Pool(args.workers) as pool:
+            results = pool.map(worker, jobs)
+        total = {k: sum(r[k] for r in results) for k in ("reads", "writes", "failed")}
+        print("{:20} {:8.1f} reads/s {:8.1f} writes/s {:6} failed".format(
+            name, total["reads"] / args.seconds, total["writes"] / args.seconds, total["failed"]))
+
+if __name__ == "__main__":
+    main()
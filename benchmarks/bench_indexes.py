@@ -0,0 +1,111 @@
+"""
+Benchmark the search query before and after the ranking index migration.
+
+Builds a synthetic database with the original, index-less schema, times the
+real ranking query from app.ranking and prints SQLite's query plan, then runs
+the 38703f43784c migration on the same data and measures again.
+
+Run from the repository root:
+
+    python benchmarks/bench_indexes.py --testers 20000 --devices 300
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The schema app.db shipped with, before any of the ranking indexes
+BASELINE_SCHEMA = """
+CREATE TABLE device (id INTEGER NOT NULL, device_name VARCHAR(64), PRIMARY KEY (id));
+CREATE UNIQUE INDEX ix_device_device_name ON device (device_name);
+CREATE TABLE tester (id INTEGER NOT NULL, first_name VARCHAR(64), last_name VARCHAR(64), country VARCHAR(2), last_login DATETIME, PRIMARY KEY (id));
+CREATE INDEX ix_tester_last_name ON tester (last_name);
+CREATE INDEX ix_tester_last_login ON tester (last_login);
+CREATE INDEX ix_tester_country ON tester (country);
+CREATE INDEX ix_tester_first_name ON tester (first_name);
+CREATE TABLE association (tester_id INTEGER, device_id INTEGER, FOREIGN KEY(tester_id) REFERENCES tester (id), FOREIGN KEY(device_id) REFERENCES device (id));
+CREATE TABLE bug (id INTEGER NOT NULL, device_id INTEGER, tester_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(device_id) REFERENCES device (id), FOREIGN KEY(tester_id) REFERENCES tester (id));
+CREATE TABLE experience (id INTEGER NOT NULL, device_id INTEGER, bugs INTEGER, tester_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(device_id) REFERENCES device (id), FOREIGN KEY(tester_id) REFERENCES tester (id));
+"""
+
+COUNTRIES = ["US", "GB", "JP", "DE", "FR", "IN", "BR", "CA"]
+
+def build(path, testers, devices, per_tester, seed):
+    # Fill the baseline schema with testers that each know a few devices
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO device VALUES (?, ?)", ((d, "Device {}".format(d)) for d in range(1, devices + 1)))
+    conn.executemany("INSERT INTO tester VALUES (?, ?, ?, ?, ?)",
+        ((t, "First", "Last", rng.choice(COUNTRIES), "2013-08-04 23:57:38") for t in range(1, testers + 1)))
+    rows = []
+    for t in range(1, testers + 1):
+        for d in rng.sample(range(1, devices + 1), per_tester):
+            rows.append((d, rng.randint(0, 100), t))
+    conn.executemany("INSERT INTO experience (device_id, bugs, tester_id) VALUES (?, ?, ?)", rows)
+    conn.executemany("INSERT INTO association VALUES (?, ?)", ((t, d) for d, _, t in rows))
+    conn.commit()
+    conn.close()
+    return len(rows)
+
+def measure(searches, repeat):
+    from app import db
+    from app.ranking import ranking_query
+    report = []
+    for country, device_ids in searches:
+        q = ranking_query(country, device_ids).limit(50)
+        sql = str(q.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+        plan = [row[-1] for row in db.session.execute("EXPLAIN QUERY PLAN " + sql)]
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            q.all()
+            times.append((time.perf_counter() - start) * 1000)
+        report.append((country, device_ids, statistics.median(times), plan))
+    return report
+
+def show(title, report):
+    print(title)
+    for country, device_ids, ms, plan in report:
+        print("  {} devices={} median {:.2f} ms".format(country, len(device_ids), ms))
+        for step in plan:
+            print("    " + step)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--testers", type=int, default=20000)
+    parser.add_argument("--devices", type=int, default=300)
+    parser.add_argument("--per-tester", type=int, default=15, help="Devices each tester has experience with")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    rows = build(path, args.testers, args.devices, args.per_tester, args.seed)
+    print("{} testers, {} devices, {} experience rows in {}".format(args.testers, args.devices, rows, path))
+
+    # The app reads its database location when it is imported
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    from app import app, db
+    from flask_migrate import stamp, upgrade
+
+    rng = random.Random(args.seed)
+    searches = [("ALL", [1]), ("US", [1]), ("ALL", rng.sample(range(1, args.devices + 1), 5)), ("GB", rng.sample(range(1, args.devices + 1), 20))]
+    with app.app_context():
+        show("Before migration", measure(searches, args.repeat))
+
+        # Start the migration and the second round on fresh connections
+        db.session.remove()
+        stamp(revision="4ff486816048")
+        upgrade(revision="38703f43784c")
+        db.session.remove()
+        show("After migration", measure(searches, args.repeat))
+
+if __name__ == "__main__":
+    main()
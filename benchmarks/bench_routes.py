@@ -0,0 +1,176 @@
+"""
+Benchmark every route of the app against a synthetic dataset, and keep the
+numbers as a JSON baseline to compare later runs with.
+
+Generates a dataset with benchmarks/synthetic.py (or reuses --database), then
+drives the home, search, bug, tester and device pages and the add, edit and
+delete flows for bugs, devices and testers through the Flask test client.
+For each route it records p50/p95/p99 latency, SQL statements per request and
+the peak of traced Python memory over one more traced request. The write flows
+delete what they added, but they do edit the database, so point --database
+at a copy.
+
+Run from the repository root:
+
+    python benchmarks/bench_routes.py --bugs 100000 --output baseline.json
+    python benchmarks/bench_routes.py --bugs 100000 --compare baseline.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+
+def percentile(values, p):
+    # Nearest rank percentile of a non empty list
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def scenarios(bugs, testers, devices):
+    """
+    The requests to time, as (name, fn) pairs in the order they are run. Each
+    fn(client, i, rng) makes the i-th request of its route and returns the
+    response. Adds run before edits and deletes, which then work on the rows
+    the adds created after the last existing ids.
+    """
+    def search(client, i, rng):
+        country = rng.choice(["ALL"] + synthetic.COUNTRIES[:4])
+        picked = sorted({rng.randint(1, devices) for _ in range(rng.randint(1, 3))})
+        return client.get("/results/{}/{}".format(country, ",".join(map(str, picked))))
+
+    return [
+        ("GET /", lambda c, i, rng: c.get("/")),
+        ("GET /index?page", lambda c, i, rng: c.get("/index?page={}".format(rng.randint(2, 20)))),
+        ("GET /results", search),
+        ("GET /results?page", lambda c, i, rng: c.get("/results/ALL/1?page={}".format(rng.randint(2, 5)))),
+        ("GET /bug", lambda c, i, rng: c.get("/bug/{}".format(rng.randint(1, bugs)))),
+        ("GET /tester", lambda c, i, rng: c.get("/tester/{}".format(rng.randint(1, testers)))),
+        ("GET /device", lambda c, i, rng: c.get("/device/{}".format(rng.randint(1, devices)))),
+        ("POST /add/Bug", lambda c, i, rng: c.post("/add/Bug", data={
+            "device_id": rng.randint(1, devices), "tester_id": rng.randint(1, testers)})),
+        ("POST /add/Device", lambda c, i, rng: c.post("/add/Device", data={"device_name": "Bench {}".format(i)})),
+        ("POST /add/Tester", lambda c, i, rng: c.post("/add/Tester", data={
+            "first_name": "Bench", "last_name": str(i), "country": rng.choice(synthetic.COUNTRIES),
+            "last_login": "2013-08-04 23:57:38", "devices": "1 {}".format(rng.randint(1, devices))})),
+        ("POST /edit/Bug", lambda c, i, rng: c.post("/edit/Bug/{}".format(bugs + i + 1), data={
+            "device_id": rng.randint(1, devices), "tester_id": rng.randint(1, testers)})),
+        ("POST /edit/Device", lambda c, i, rng: c.post("/edit/Device/{}".format(devices + i + 1), data={
+            "device_name": "Bench renamed {}".format(i)})),
+        ("POST /edit/Tester", lambda c, i, rng: c.post("/edit/Tester/{}".format(testers + i + 1), data={
+            "first_name": "Bench", "last_name": "Renamed", "country": rng.choice(synthetic.COUNTRIES), "devices": "1"})),
+        ("POST /delete/Bug", lambda c, i, rng: c.post("/delete/Bug/{}".format(bugs + i + 1), data={"areYouSure": "y"})),
+        ("POST /delete/Device", lambda c, i, rng: c.post("/delete/Device/{}".format(devices + i + 1), data={"areYouSure": "y"})),
+        ("POST /delete/Tester", lambda c, i, rng: c.post("/delete/Tester/{}".format(testers + i + 1), data={"areYouSure": "y"})),
+    ]
+
+def run(client, fn, repeat, rng, counter):
+    # repeat timed requests, then one more under tracemalloc for peak memory
+    times, queries, statuses = [], [], set()
+    for i in range(repeat):
+        counter[0] = 0
+        start = time.perf_counter()
+        response = fn(client, i, rng)
+        times.append((time.perf_counter() - start) * 1000)
+        queries.append(counter[0])
+        statuses.add(response.status_code)
+    tracemalloc.start()
+    statuses.add(fn(client, repeat, rng).status_code)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "p50_ms": round(percentile(times, 50), 3),
+        "p95_ms": round(percentile(times, 95), 3),
+        "p99_ms": round(percentile(times, 99), 3),
+        "queries": statistics.median(queries),
+        "peak_mib": round(peak / 2 ** 20, 3),
+        "statuses": sorted(statuses),
+    }
+
+def compare(results, baseline, tolerance, min_ms):
+    """
+    Print each route's p50 and queries against the baseline
+
+    Returns:
+      Names of the routes whose p50 grew by more than tolerance (and more
+      than min_ms, so sub millisecond noise is ignored), or that now run more
+      queries per request
+    """
+    regressed = []
+    for name, now in results["routes"].items():
+        before = baseline["routes"].get(name)
+        if before is None:
+            continue
+        ratio = now["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+        flag = ""
+        slower = ratio > 1 + tolerance and now["p50_ms"] - before["p50_ms"] > min_ms
+        if slower or now["queries"] > before["queries"]:
+            regressed.append(name)
+            flag = "  REGRESSED"
+        print("{:22} p50 {:9.2f} -> {:9.2f} ms ({:5.2f}x)  queries {:5} -> {:5}{}".format(
+            name, before["p50_ms"], now["p50_ms"], ratio, before["queries"], now["queries"], flag))
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bugs", type=int, default=100000)
+    parser.add_argument("--database", help="Benchmark this database instead of generating one")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed p50 growth over the baseline")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="Ignore p50 growth smaller than this")
+    args = parser.parse_args()
+
+    path = args.database or os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.abspath(path)
+    from app import app, db
+    from app.models import Bug, Device, Tester
+    from sqlalchemy import event, func
+
+    app.config["WTF_CSRF_ENABLED"] = False
+    with app.app_context():
+        if not args.database:
+            synthetic.create_schema()
+            synthetic.generate(args.bugs, seed=args.seed)
+        bugs = db.session.query(func.max(Bug.id)).scalar()
+        testers = db.session.query(func.max(Tester.id)).scalar()
+        devices = db.session.query(func.max(Device.id)).scalar()
+        engine = db.engine
+        db.session.remove()
+
+    counter = [0]
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        counter[0] += 1
+
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    results = {"dataset": {"bugs": bugs, "testers": testers, "devices": devices, "seed": args.seed},
+        "repeat": args.repeat, "routes": {}}
+    for name, fn in scenarios(bugs, testers, devices):
+        stats = run(client, fn, args.repeat, rng, counter)
+        results["routes"][name] = stats
+        print("{:22} p50 {:8.2f}  p95 {:8.2f}  p99 {:8.2f} ms  {:5} queries  {:8.2f} MiB  {}".format(
+            name, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["queries"], stats["peak_mib"], stats["statuses"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance, args.min_ms):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
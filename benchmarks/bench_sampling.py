@@ -0,0 +1,90 @@
+"""
+Benchmark the home page's bug sampling against loading the whole bug table.
+
+Fills a synthetic database with bugs, growing it through each of the given
+sizes, and at each size compares the latency and peak Python memory of the
+old random.choices(query(Bug).all(), k=10) with app.sampling.sample_rows,
+and of the whole home page.
+
+Run from the repository root:
+
+    python benchmarks/bench_sampling.py --sizes 10000 1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def grow(path, start, stop, testers, devices, rng):
+    # Append bugs with ids start+1..stop, filed by random testers on random devices
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO bug (id, device_id, tester_id) VALUES (?, ?, ?)",
+        ((i, rng.randint(1, devices), rng.randint(1, testers)) for i in range(start + 1, stop + 1)))
+    conn.commit()
+    conn.close()
+
+def measure(fn, repeat):
+    # Median latency in ms over untraced runs, then the peak of traced Python
+    # memory in MiB over one more run, since tracing slows everything down
+    from app import db
+    times = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    db.session.remove()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times), peak / 2 ** 20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 1000000])
+    parser.add_argument("--testers", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + path
+    from app import app, db
+    from app.models import Bug
+    from app.sampling import sample_rows
+    from flask_migrate import upgrade
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        upgrade()
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO device (id, device_name) VALUES (?, ?)", ((d, "Device {}".format(d)) for d in range(1, args.devices + 1)))
+    conn.executemany("INSERT INTO tester (id, first_name, last_name, country, last_login) VALUES (?, 'First', 'Last', 'US', '2013-08-04 23:57:38')", ((t,) for t in range(1, args.testers + 1)))
+    conn.commit()
+    conn.close()
+
+    client = app.test_client()
+    size = 0
+    for target in sorted(args.sizes):
+        grow(path, size, target, args.testers, args.devices, rng)
+        size = target
+        with app.app_context():
+            full = measure(lambda: random.choices(db.session.query(Bug).all(), k=10), args.repeat)
+            sampled = measure(lambda: sample_rows(Bug, 10), args.repeat)
+        page = measure(lambda: client.get("/"), args.repeat)
+        print("{} bugs".format(size))
+        print("  load all + random.choices  {:9.2f} ms {:9.2f} MiB".format(*full))
+        print("  sample_rows                {:9.2f} ms {:9.2f} MiB".format(*sampled))
+        print("  GET /                      {:9.2f} ms {:9.2f} MiB".format(*page))
+
+if __name__ == "__main__":
+    main()
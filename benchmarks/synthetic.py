@@ -0,0 +1,135 @@
+"""
+Generate a synthetic TesterMatch dataset at production scale.
+
+Countries, device popularity and tester activity all follow skewed (Zipf
+like) distributions, so a few countries hold most testers, a few devices
+most bugs, and a few testers file most of them. Testers own a handful of
+devices and file nearly all their bugs on those. Experience is derived from
+the bugs afterwards, the same way flask rebuild-experience does it.
+
+Writes into the database the app is configured for (DATABASE_URL), creating
+the schema with the migrations when the tables do not exist yet:
+
+    DATABASE_URL=sqlite:////tmp/big.db python benchmarks/synthetic.py --bugs 1000000
+"""
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+COUNTRIES = ["US", "GB", "JP", "DE", "IN", "BR", "FR", "CA", "CN", "KR", "AU", "MX", "ES", "IT", "PL", "NL"]
+FIRST_NAMES = ["Miguel", "Michael", "Leonard", "Taybin", "Mingquan", "Stanley", "Lucas", "Sean", "Darshini", "Ana", "Yuki", "Priya", "Olga", "Kwame"]
+LAST_NAMES = ["Bautista", "Lubavin", "Sutton", "Rutkin", "Zheng", "Chu", "Lowry", "Wellington", "Santhanam", "Silva", "Tanaka", "Patel", "Ivanova", "Mensah"]
+MODELS = ["iPhone", "Galaxy", "Pixel", "Droid", "Xperia", "Moto", "Nexus", "OnePlus", "Lumia", "Redmi"]
+
+def zipf_weights(n, s=1.1):
+    return [1.0 / (i ** s) for i in range(1, n + 1)]
+
+class Picker(object):
+    """
+    Draws indexes 0..n-1 with the given weights in O(log n) per draw
+    """
+    def __init__(self, weights, rng):
+        self.cumulative = list(itertools.accumulate(weights))
+        self.rng = rng
+
+    def __call__(self):
+        return bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+def scale_for(bugs):
+    # Tester and device counts that grow with the number of bugs
+    return max(10, bugs // 50), max(10, min(2000, bugs // 5000))
+
+def generate(bugs, testers=None, devices=None, seed=0, chunk_size=20000, log=print):
+    """
+    Fill the configured database with a synthetic dataset. Call inside an
+    application context.
+
+    Args:
+      bugs:       Number of bugs to file
+      testers:    Number of testers, scaled from bugs by default
+      devices:    Number of devices, scaled from bugs by default
+      seed:       Seed making the dataset repeatable
+      chunk_size: Rows per bulk insert
+      log:        Function called with progress messages
+    Returns:
+      Dict of table name to number of rows written
+    """
+    from app import db
+    from app.experience import rebuild_experience
+    from app.importer import chunked
+    from app.models import association_table, Bug, Device, Tester
+    from datetime import datetime, timedelta
+
+    default_testers, default_devices = scale_for(bugs)
+    testers = testers or default_testers
+    devices = devices or default_devices
+    rng = random.Random(seed)
+    counts = {}
+
+    def insert(table, rows):
+        start = time.perf_counter()
+        n = 0
+        for chunk in chunked(rows, chunk_size):
+            db.session.execute(table.insert(), chunk)
+            n += len(chunk)
+        counts[table.name] = n
+        log("{}: {} rows in {:.1f}s".format(table.name, n, time.perf_counter() - start))
+
+    insert(Device.__table__, ({"id": d, "device_name": "{} {}".format(MODELS[d % len(MODELS)], d)} for d in range(1, devices + 1)))
+
+    country = Picker(zipf_weights(len(COUNTRIES)), rng)
+    epoch = datetime(2013, 1, 1)
+    insert(Tester.__table__, ({
+        "id": t,
+        "first_name": rng.choice(FIRST_NAMES),
+        "last_name": rng.choice(LAST_NAMES),
+        "country": COUNTRIES[country()],
+        "last_login": epoch + timedelta(seconds=rng.randint(0, 3 * 365 * 86400)),
+    } for t in range(1, testers + 1)))
+
+    # Every tester owns one to eight devices, popular ones more often
+    device = Picker(zipf_weights(devices), rng)
+    owned = [sorted({device() + 1 for _ in range(rng.randint(1, 8))}) for _ in range(testers)]
+    insert(association_table, ({"tester_id": t + 1, "device_id": d} for t in range(testers) for d in owned[t]))
+
+    # A few testers file most of the bugs, almost always on devices they own
+    tester = Picker(zipf_weights(testers, 0.8), rng)
+    def bug_rows():
+        for b in range(1, bugs + 1):
+            t = tester()
+            d = rng.choice(owned[t]) if rng.random() < 0.95 else device() + 1
+            yield {"id": b, "tester_id": t + 1, "device_id": d}
+    insert(Bug.__table__, bug_rows())
+
+    start = time.perf_counter()
+    counts["experience"] = rebuild_experience()
+    db.session.commit()
+    log("experience: {} rows in {:.1f}s".format(counts["experience"], time.perf_counter() - start))
+    return counts
+
+def create_schema():
+    # Bring an empty database up to the latest migration
+    from flask_migrate import upgrade
+    upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations"))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bugs", type=int, default=10000)
+    parser.add_argument("--testers", type=int, help="Scaled from --bugs by default")
+    parser.add_argument("--devices", type=int, help="Scaled from --bugs by default")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from app import app
+    with app.app_context():
+        create_schema()
+        generate(args.bugs, args.testers, args.devices, args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -6,4 +6,97 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config(object):
     SECRET_KEY = os.environ.get("SECRET_KEY") or "devPass"
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL") or "sqlite:///" + os.path.join(basedir, "app.db")
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool of the database engine, ignored for SQLite files which
+    # open a connection per checkout. Pre ping drops connections the server
+    # closed before they are handed out
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE") or 5)
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW") or 10)
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT") or 30)
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE") or 1800)
+    DB_POOL_PRE_PING = (os.environ.get("DB_POOL_PRE_PING") or "1") != "0"
+
+    # Pragmas set on every SQLite connection: write ahead logging so readers
+    # are not blocked by writers, milliseconds to wait for a lock, and how
+    # often to sync to disk (NORMAL is safe in WAL mode)
+    SQLITE_WAL = (os.environ.get("SQLITE_WAL") or "1") != "0"
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get("SQLITE_BUSY_TIMEOUT") or 5000)
+    SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS") or "NORMAL"
+    # Enforce foreign keys, so deleting a tester or device cascades to its
+    # bugs, Experience rows and device links (SQLite leaves them off)
+    SQLITE_FOREIGN_KEYS = (os.environ.get("SQLITE_FOREIGN_KEYS") or "1") != "0"
+
+    # Optional database, e.g. a replica, that pages which only read are
+    # served from. Writes always go to DATABASE_URL
+    DATABASE_READ_URL = os.environ.get("DATABASE_READ_URL")
+
+    # Number of testers shown on each page of search results
+    RESULTS_PER_PAGE = int(os.environ.get("RESULTS_PER_PAGE") or 50)
+
+    # Number of testers and devices listed on each page of the home page
+    INDEX_PAGE_SIZE = int(os.environ.get("INDEX_PAGE_SIZE") or 25)
+
+    # JSON API page sizes: default and largest testers per page, and how many
+    # testers are fetched from the database at a time while streaming a page
+    API_DEFAULT_LIMIT = int(os.environ.get("API_DEFAULT_LIMIT") or 100)
+    API_MAX_LIMIT = int(os.environ.get("API_MAX_LIMIT") or 100000)
+    API_CHUNK_SIZE = int(os.environ.get("API_CHUNK_SIZE") or 500)
+
+    # Rows read from the database at a time by table exports
+    EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE") or 10000)
+
+    # Append every write to the change_log table, read back through
+    # /api/v1/changes, most changes per page of it, and days kept by
+    # flask trim-changes
+    CHANGE_LOG_ENABLED = (os.environ.get("CHANGE_LOG_ENABLED") or "1") != "0"
+    CHANGES_MAX_LIMIT = int(os.environ.get("CHANGES_MAX_LIMIT") or 10000)
+    CHANGE_LOG_RETENTION_DAYS = int(os.environ.get("CHANGE_LOG_RETENTION_DAYS") or 30)
+
+    # Largest number of operations accepted by /api/v1/batch
+    BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS") or 10000)
+
+    # Bug purges up to this size report every deleted bug to the caches and
+    # indexes, larger ones have them rebuilt
+    PURGE_ITEMIZE_MAX = int(os.environ.get("PURGE_ITEMIZE_MAX") or 1000)
+
+    # /api/v1/match/batch: most searches per request, and threads running
+    # them at the same time
+    MULTI_SEARCH_MAX = int(os.environ.get("MULTI_SEARCH_MAX") or 100)
+    MULTI_SEARCH_WORKERS = int(os.environ.get("MULTI_SEARCH_WORKERS") or 8)
+
+    # Search result cache: number of searches kept, seconds before an entry
+    # expires, and an optional sqlite file to share it between processes
+    SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE") or 1024)
+    SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL") or 300)
+    SEARCH_CACHE_PATH = os.environ.get("SEARCH_CACHE_PATH")
+
+    # Rendered partials kept in memory, 0 turns the fragment cache off
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE") or 20000)
+
+    # Most seconds between reloads of the in memory device catalog, which
+    # also reloads when other worker processes write devices
+    DEVICE_CATALOG_TTL = int(os.environ.get("DEVICE_CATALOG_TTL") or 60)
+
+    # Testers kept per (country, device) leaderboard, 0 to turn them off,
+    # and the most devices a search may have to be answered from them.
+    # Run flask rebuild-leaderboards after changing the size
+    LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE") or 100)
+    LEADERBOARD_MAX_DEVICES = int(os.environ.get("LEADERBOARD_MAX_DEVICES") or 3)
+
+    # Search engine used by default, "sql" or "matrix" for the in memory
+    # index (needs numpy), and seconds before that index is rebuilt
+    MATCH_ENGINE = os.environ.get("MATCH_ENGINE") or "sql"
+    MATCH_INDEX_MAX_AGE = int(os.environ.get("MATCH_INDEX_MAX_AGE") or 300)
+
+    # Seconds before the device owner bitsets behind match=all|any searches
+    # are rebuilt, to pick up writes from other processes
+    OWNER_INDEX_MAX_AGE = int(os.environ.get("OWNER_INDEX_MAX_AGE") or 300)
+    # Up to this many owners, their bug counts are looked up by tester id,
+    # past it owners are picked out of the whole ranking
+    OWNER_LOOKUP_MAX = int(os.environ.get("OWNER_LOOKUP_MAX") or 5000)
+
+    # Per request timing of views, templates and SQL, served at /metrics.
+    # Requests slower than SLOW_REQUEST_MS are logged with their statements
+    METRICS_ENABLED = (os.environ.get("METRICS_ENABLED") or "1") != "0"
+    SLOW_REQUEST_MS = int(os.environ.get("SLOW_REQUEST_MS") or 500)
@@ -0,0 +1,49 @@
+"""cascading deletes
+
+Revision ID: 048039fc8903
+Revises: 6733af8e5f26
+Create Date: 2026-10-18 16:02:44.518203
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '048039fc8903'
+down_revision = '6733af8e5f26'
+branch_labels = None
+depends_on = None
+
+# SQLite reflects the foreign keys without names, batch mode names them with
+# this so they can be dropped
+NAMING = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+CHILDREN = ('bug', 'experience', 'association')
+
+
+def _foreign_keys(ondelete):
+    for table in CHILDREN:
+        with op.batch_alter_table(table, recreate='always', naming_convention=NAMING) as batch_op:
+            for column, parent in (('tester_id', 'tester'), ('device_id', 'device')):
+                name = NAMING['fk'] % {'table_name': table, 'column_0_name': column, 'referred_table_name': parent}
+                batch_op.drop_constraint(name, type_='foreignkey')
+                batch_op.create_foreign_key(name, parent, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    # Rows left behind by testers and devices deleted before the foreign keys
+    # were enforced, which would fail the checks once they are. Experience
+    # rows of deleted testers had their tester set to NULL
+    for table in CHILDREN:
+        op.execute('DELETE FROM {0} WHERE tester_id NOT IN (SELECT id FROM tester) '
+            'OR device_id NOT IN (SELECT id FROM device)'.format(table))
+    op.execute('DELETE FROM experience WHERE tester_id IS NULL OR device_id IS NULL')
+    op.execute('DELETE FROM leaderboard WHERE tester_id NOT IN (SELECT id FROM tester) '
+        'OR device_id NOT IN (SELECT id FROM device)')
+    op.execute('DELETE FROM leaderboard_floor WHERE device_id NOT IN (SELECT id FROM device)')
+
+    _foreign_keys('CASCADE')
+
+
+def downgrade():
+    _foreign_keys(None)
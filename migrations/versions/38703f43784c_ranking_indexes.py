@@ -0,0 +1,69 @@
+"""ranking indexes
+
+Revision ID: 38703f43784c
+Revises: 4ff486816048
+Create Date: 2026-10-18 10:26:22.802648
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '38703f43784c'
+down_revision = '4ff486816048'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fold duplicate experience rows into one per tester/device pair so the
+    # pair can be made unique
+    op.execute(
+        'UPDATE experience SET bugs = (SELECT SUM(e.bugs) FROM experience e '
+        'WHERE e.tester_id = experience.tester_id AND e.device_id = experience.device_id) '
+        'WHERE id IN (SELECT MIN(id) FROM experience GROUP BY tester_id, device_id HAVING COUNT(*) > 1)')
+    op.execute('DELETE FROM experience WHERE id NOT IN (SELECT MIN(id) FROM experience GROUP BY tester_id, device_id)')
+    with op.batch_alter_table('experience') as batch_op:
+        batch_op.create_unique_constraint('uq_experience_tester_device', ['tester_id', 'device_id'])
+        batch_op.create_index('ix_experience_device_tester_bugs', ['device_id', 'tester_id', 'bugs'], unique=False)
+
+    # Copy the distinct associations into a table keyed on the pair
+    op.create_table('association_new',
+    sa.Column('tester_id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['tester_id'], ['tester.id'], ),
+    sa.PrimaryKeyConstraint('tester_id', 'device_id')
+    )
+    op.execute(
+        'INSERT INTO association_new (tester_id, device_id) SELECT DISTINCT tester_id, device_id '
+        'FROM association WHERE tester_id IS NOT NULL AND device_id IS NOT NULL')
+    op.drop_table('association')
+    op.rename_table('association_new', 'association')
+    op.create_index(op.f('ix_association_device_id'), 'association', ['device_id'], unique=False)
+
+    op.create_index(op.f('ix_bug_device_id'), 'bug', ['device_id'], unique=False)
+    op.create_index('ix_bug_tester_device', 'bug', ['tester_id', 'device_id'], unique=False)
+    op.create_index('ix_tester_country_id', 'tester', ['country', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tester_country_id', table_name='tester')
+    op.drop_index('ix_bug_tester_device', table_name='bug')
+    op.drop_index(op.f('ix_bug_device_id'), table_name='bug')
+
+    op.drop_index(op.f('ix_association_device_id'), table_name='association')
+    op.create_table('association_old',
+    sa.Column('tester_id', sa.Integer(), nullable=True),
+    sa.Column('device_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['tester_id'], ['tester.id'], )
+    )
+    op.execute('INSERT INTO association_old (tester_id, device_id) SELECT tester_id, device_id FROM association')
+    op.drop_table('association')
+    op.rename_table('association_old', 'association')
+
+    with op.batch_alter_table('experience') as batch_op:
+        batch_op.drop_index('ix_experience_device_tester_bugs')
+        batch_op.drop_constraint('uq_experience_tester_device', type_='unique')
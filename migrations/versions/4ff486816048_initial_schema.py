@@ -0,0 +1,75 @@
+"""initial schema
+
+Revision ID: 4ff486816048
+Revises: 
+Create Date: 2026-10-18 10:26:01.409124
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4ff486816048'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The schema app.db shipped with before migrations were tracked. Existing
+    # databases already have it and only need `flask db stamp 4ff486816048`
+    op.create_table('device',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_name', sa.String(length=64), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_device_device_name'), 'device', ['device_name'], unique=True)
+    op.create_table('tester',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('first_name', sa.String(length=64), nullable=True),
+    sa.Column('last_name', sa.String(length=64), nullable=True),
+    sa.Column('country', sa.String(length=2), nullable=True),
+    sa.Column('last_login', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_tester_country'), 'tester', ['country'], unique=False)
+    op.create_index(op.f('ix_tester_first_name'), 'tester', ['first_name'], unique=False)
+    op.create_index(op.f('ix_tester_last_login'), 'tester', ['last_login'], unique=False)
+    op.create_index(op.f('ix_tester_last_name'), 'tester', ['last_name'], unique=False)
+    op.create_table('association',
+    sa.Column('tester_id', sa.Integer(), nullable=True),
+    sa.Column('device_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['tester_id'], ['tester.id'], )
+    )
+    op.create_table('bug',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=True),
+    sa.Column('tester_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['tester_id'], ['tester.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('experience',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=True),
+    sa.Column('bugs', sa.Integer(), nullable=True),
+    sa.Column('tester_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['device_id'], ['device.id'], ),
+    sa.ForeignKeyConstraint(['tester_id'], ['tester.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('experience')
+    op.drop_table('bug')
+    op.drop_table('association')
+    op.drop_index(op.f('ix_tester_last_name'), table_name='tester')
+    op.drop_index(op.f('ix_tester_last_login'), table_name='tester')
+    op.drop_index(op.f('ix_tester_first_name'), table_name='tester')
+    op.drop_index(op.f('ix_tester_country'), table_name='tester')
+    op.drop_table('tester')
+    op.drop_index(op.f('ix_device_device_name'), table_name='device')
+    op.drop_table('device')
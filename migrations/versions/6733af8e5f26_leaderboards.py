@@ -0,0 +1,58 @@
+"""leaderboards
+
+Revision ID: 6733af8e5f26
+Revises: c58f84dd3d16
+Create Date: 2026-10-18 11:31:09.104275
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6733af8e5f26'
+down_revision = 'c58f84dd3d16'
+branch_labels = None
+depends_on = None
+
+# Default LEADERBOARD_SIZE, flask rebuild-leaderboards applies another one
+SIZE = 100
+
+RANKED = (
+    "SELECT {country} AS country, e.device_id, e.tester_id, e.bugs, "
+    "ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY e.bugs DESC, e.tester_id) AS place "
+    "FROM experience e {join} "
+    "WHERE e.bugs > 0 AND e.tester_id IS NOT NULL AND e.device_id IS NOT NULL {where}")
+
+
+def upgrade():
+    op.create_table('leaderboard',
+    sa.Column('country', sa.String(length=3), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.Column('tester_id', sa.Integer(), nullable=False),
+    sa.Column('bugs', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('country', 'device_id', 'tester_id')
+    )
+    op.create_index(op.f('ix_leaderboard_tester_id'), 'leaderboard', ['tester_id'], unique=False)
+    op.create_table('leaderboard_floor',
+    sa.Column('country', sa.String(length=3), nullable=False),
+    sa.Column('device_id', sa.Integer(), nullable=False),
+    sa.Column('bugs', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('country', 'device_id')
+    )
+
+    # Fill the boards from Experience, they are kept up to date from here on
+    for ranked in (
+            RANKED.format(country="'ALL'", partition="e.device_id", join="", where=""),
+            RANKED.format(country="t.country", partition="t.country, e.device_id",
+                join="JOIN tester t ON t.id = e.tester_id", where="AND t.country IS NOT NULL")):
+        op.execute('INSERT INTO leaderboard (country, device_id, tester_id, bugs) '
+            'SELECT country, device_id, tester_id, bugs FROM ({}) WHERE place <= {}'.format(ranked, SIZE))
+        op.execute('INSERT INTO leaderboard_floor (country, device_id, bugs) '
+            'SELECT country, device_id, bugs FROM ({}) WHERE place = {}'.format(ranked, SIZE + 1))
+
+
+def downgrade():
+    op.drop_table('leaderboard_floor')
+    op.drop_index(op.f('ix_leaderboard_tester_id'), table_name='leaderboard')
+    op.drop_table('leaderboard')
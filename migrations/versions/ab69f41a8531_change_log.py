@@ -0,0 +1,36 @@
+"""change log
+
+Revision ID: ab69f41a8531
+Revises: 048039fc8903
+Create Date: 2026-10-18 11:17:11.334620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ab69f41a8531'
+down_revision = '048039fc8903'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Starts empty: consumers begin from a full read of the tables and follow
+    # the log from there
+    op.create_table('change_log',
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('table_name', sa.String(length=16), nullable=False),
+    sa.Column('op', sa.String(length=8), nullable=False),
+    sa.Column('key', sa.String(length=32), nullable=True),
+    sa.Column('old', sa.Text(), nullable=True),
+    sa.Column('new', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('seq'),
+    sqlite_autoincrement=True
+    )
+
+
+def downgrade():
+    op.drop_table('change_log')
@@ -0,0 +1,42 @@
+"""row versions and write generations
+
+Revision ID: c58f84dd3d16
+Revises: 38703f43784c
+Create Date: 2026-10-18 11:02:47.318520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58f84dd3d16'
+down_revision = '38703f43784c'
+branch_labels = None
+depends_on = None
+
+TABLES = ['bug', 'device', 'tester']
+GENERATIONS = ['all', 'bug', 'tester', 'device', 'association', 'experience']
+
+
+def upgrade():
+    # Existing rows start at version 1 with an unknown update time
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    generation = op.create_table('generation',
+    sa.Column('name', sa.String(length=16), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(generation, [{'name': name, 'value': 0} for name in GENERATIONS])
+
+
+def downgrade():
+    op.drop_table('generation')
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')